@@ -2,8 +2,16 @@
 
 import time
 import sys
+import os
+import json
+import tempfile
 from math import sqrt
+from collections import OrderedDict
+from multiprocessing import Pool, cpu_count
+from multiprocessing.shared_memory import SharedMemory
 import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.linalg import splu
 
 # a simple 4-node graph from the course slides
 simple_graph = {
@@ -13,10 +21,10 @@ simple_graph = {
   "4": ["2"]
 }
 
-def read_airports():
+def read_airports(filename="airports.txt"):
 # sample line:
 # 1382,"Charles De Gaulle","Paris","France","CDG","LFPG",49.012779,2.55,392,1,"E"
-    airportsTxt = open("airports.txt", "r",encoding="utf8");
+    airportsTxt = open(filename, "r",encoding="utf8");
     cont = 0
     airport_dict = {}
     for line in airportsTxt.readlines():
@@ -39,11 +47,11 @@ def read_airports():
     print(len(airport_dict), "airports read successfully")
     return airport_dict
 
-def read_routes(airp):
+def read_routes(airp, remove_sinks=True, filename="routes.txt"):
 # sample line:
 # AB,214,CDG,1382,VIE,1613,Y,0,320 321
 # note: there are no " quotes around airport names, unlike in airports.txt
-    routesTxt = open("routes.txt", "r",encoding="utf8");
+    routesTxt = open(filename, "r",encoding="utf8");
     cont = 0
     route_dict = {}
     nroutes = 0
@@ -66,8 +74,10 @@ def read_routes(airp):
 
     # remove sinks: airports to which some route arrives
     # but from which no route leaves
-    for i in route_dict.keys():
-        route_dict[i] = [ j for j in route_dict[i] if j in route_dict]
+    # (not needed by compute_pageranks_sparse, which handles them itself)
+    if remove_sinks:
+        for i in route_dict.keys():
+            route_dict[i] = [ j for j in route_dict[i] if j in route_dict]
 
     return route_dict
 
@@ -99,6 +109,626 @@ def compute_pageranks(g,d):
 
     return pagerank, iter
 
+def index_graph(g):
+    '''
+    Gives every node of the adjacency dict g an integer id and returns
+    (nodes, src, dst): the list of node keys in id order and two int32
+    arrays with one entry per edge. Nodes are numbered in the order of
+    the keys of g, followed by destinations that are not keys of g.
+    '''
+    nodes = list(g.keys())
+    ids = {key: index for index, key in enumerate(nodes)}
+    src, dst = [], []
+    for node, adjs in g.items():
+        i = ids[node]
+        for adj in adjs:
+            if adj not in ids:
+                ids[adj] = len(nodes)
+                nodes.append(adj)
+            src.append(i)
+            dst.append(ids[adj])
+    return nodes, np.array(src, dtype=np.int32), np.array(dst, dtype=np.int32)
+
+def transition_matrix(src, dst, n):
+    '''
+    Builds the CSR matrix M with M[j,i] = (#edges i->j) / outdegree(i),
+    so that one PageRank step is a single mat-vec M @ p. Also returns
+    the boolean mask of dangling nodes (outdegree 0).
+    '''
+    outdeg = np.bincount(src, minlength=n)
+    weights = 1/outdeg[src]
+    M = sp.csr_matrix((weights, (dst, src)), shape=(n, n))
+    return M, outdeg == 0
+
+def compile_graph(g):
+    '''
+    Compiles the adjacency dict g once into (nodes, M, dangling).
+    '''
+    nodes, src, dst = index_graph(g)
+    M, dangling = transition_matrix(src, dst, len(nodes))
+    return nodes, M, dangling
+
+def sparse_power_iteration(M, dangling, d, epsilon=0.00001, p=None):
+    '''
+    Power iteration on a compiled graph, starting from p (uniform by
+    default). The rank of dangling nodes is spread uniformly over all
+    nodes, so p keeps summing to 1. Stops with the same criterion as
+    compute_pageranks: the 2-norm of the change is at most epsilon.
+    '''
+    n = M.shape[0]
+    if p is None:
+        p = 1/n*np.ones(n)
+    dist = 1
+    iterations = 0
+    while dist > epsilon:
+        pnew = d * (M @ p)
+        pnew += (d * p[dangling].sum() + 1-d) / n
+        dist = np.linalg.norm(p-pnew)
+        p = pnew
+        iterations += 1
+    return p, iterations
+
+'''
+Sparse-matrix implementation of PageRank: the graph is compiled into
+a CSR transition matrix once and every iteration is a sparse mat-vec
+'''
+def compute_pageranks_sparse(g, d, epsilon=0.00001):
+    nodes, M, dangling = compile_graph(g)
+    p, iterations = sparse_power_iteration(M, dangling, d, epsilon)
+    pagerank = {key: p[i] for i, key in enumerate(nodes)}
+    return pagerank, iterations
+
+def gauss_seidel_iteration(M, dangling, d, epsilon=0.00001):
+    '''
+    Gauss-Seidel sweeps on (I - d*M) p = teleport: every node is updated
+    in place using the ranks already updated in the same sweep, which is
+    one sparse triangular solve per sweep. The dangling mass is taken
+    from the previous sweep.
+    It needs fewer sweeps than Jacobi (7 vs 12 on a 3M-edge power-law
+    graph) but is not faster: the triangular part is factored once by
+    SuperLU (kept in the natural order, so the factor is the triangle
+    itself) and that setup alone costs about two Jacobi runs.
+    If that triangle is singular, this is plain Jacobi.
+    '''
+    n = M.shape[0]
+    A = sp.identity(n, format="csr") - d * M
+    lower = sp.tril(A, format="csc")
+    if not lower.diagonal().all():
+        # d = 1 and some node only links to itself: its row cannot be
+        # solved for, so fall back to Jacobi
+        return sparse_power_iteration(M, dangling, d, epsilon)
+    L = splu(lower, permc_spec="NATURAL", diag_pivot_thresh=0)
+    U = sp.triu(A, k=1, format="csr")
+    p = 1/n*np.ones(n)
+    dist = 1
+    iterations = 0
+    while dist > epsilon:
+        rhs = (d * p[dangling].sum() + 1-d) / n - U @ p
+        pnew = L.solve(rhs)
+        pnew /= pnew.sum()
+        dist = np.linalg.norm(p-pnew)
+        p = pnew
+        iterations += 1
+    return p, iterations
+
+def _aitken(x1, x2, ratio):
+    '''
+    Aitken extrapolation of two iterates whose differences shrink by
+    'ratio' every step: the limit of x2 + ratio^k (x2 - x1) summed over k
+    '''
+    return x2 + ratio / (1 - ratio) * (x2 - x1)
+
+def _quadratic(x0, x1, x2, x3):
+    ''' quadratic extrapolation (Kamvar et al.) of four iterates '''
+    Y = np.column_stack((x1 - x0, x2 - x0))
+    gamma = np.linalg.lstsq(Y, -(x3 - x0), rcond=None)[0]
+    beta0 = gamma[0] + gamma[1] + 1
+    beta1 = gamma[1] + 1
+    return beta0*x1 + beta1*x2 + x3
+
+def extrapolated_iteration(M, dangling, d, epsilon=0.00001, method="aitken",
+                           every=10, tol=0.02):
+    '''
+    Power iteration that replaces the current iterate by an extrapolation
+    of the last iterates, removing the slowest-decaying error components.
+    Quadratic extrapolation is applied every 'every' steps. Aitken is only
+    applied once the ratio between successive steps has settled (its last
+    three values within tol of each other), as in Kamvar et al.: a single
+    error component then dominates and the ratio estimates its eigenvalue,
+    sign included. An extrapolation that increases the residual is undone
+    and the iteration goes on without extrapolating.
+    '''
+    n = M.shape[0]
+    p = 1/n*np.ones(n)
+    history = [p]
+    ratios = []
+    step = None
+    # iterate replaced by the last extrapolation, and its residual
+    undo = None
+    dist = 1
+    iterations = 0
+    while dist > epsilon:
+        pnew = d * (M @ p)
+        pnew += (d * p[dangling].sum() + 1-d) / n
+        dist = np.linalg.norm(p-pnew)
+        iterations += 1
+        if undo is not None:
+            kept, before = undo
+            undo = None
+            if dist > before:
+                p, dist = kept, before
+                history, ratios, step = [p], [], None
+                method = None
+                continue
+        if step is not None:
+            ratios.append((pnew-p) @ step / (step @ step))
+        step = pnew - p
+        history = (history + [pnew])[-4:]
+        extrapolated = None
+        if dist <= epsilon:
+            pass
+        elif method == "aitken":
+            last = ratios[-3:]
+            if (len(last) == 3 and abs(last[-1]) < 1 and
+                    max(last) - min(last) < tol * abs(last[-1])):
+                extrapolated = _aitken(p, pnew, last[-1])
+        elif (method == "quadratic" and iterations % every == 0 and
+                len(history) == 4):
+            extrapolated = _quadratic(*history)
+        if extrapolated is not None:
+            undo = (pnew, dist)
+            pnew = np.maximum(extrapolated, 0)
+            pnew /= pnew.sum()
+            history, ratios, step = [pnew], [], None
+        p = pnew
+    return p, iterations
+
+def adaptive_iteration(M, dangling, d, epsilon=0.00001, patience=3):
+    '''
+    Adaptive PageRank: a node whose rank changed by less than
+    epsilon/sqrt(n) in 'patience' consecutive steps is frozen, and later
+    steps only recompute the rows of the nodes that are still active.
+    '''
+    n = M.shape[0]
+    p = 1/n*np.ones(n)
+    active = np.arange(n)
+    Mactive = M
+    freeze = epsilon / sqrt(n)
+    calm = np.zeros(n, dtype=int)
+    dist = 1
+    iterations = 0
+    while dist > epsilon and len(active) > 0:
+        pnew = d * (Mactive @ p)
+        pnew += (d * p[dangling].sum() + 1-d) / n
+        change = np.abs(pnew - p[active])
+        dist = np.linalg.norm(change)
+        p[active] = pnew
+        iterations += 1
+        calm[active] = np.where(change < freeze, calm[active]+1, 0)
+        moving = calm[active] < patience
+        if not moving.all():
+            active = active[moving]
+            Mactive = M[active]
+    # frozen nodes kept their last rank, so the total drifts a little
+    p /= p.sum()
+    return p, iterations
+
+# solver modes for compute_pageranks_solver
+solvers = {
+    "jacobi": sparse_power_iteration,
+    "gauss-seidel": gauss_seidel_iteration,
+    "aitken": lambda M, dangling, d, epsilon: extrapolated_iteration(
+        M, dangling, d, epsilon, method="aitken"),
+    "quadratic": lambda M, dangling, d, epsilon: extrapolated_iteration(
+        M, dangling, d, epsilon, method="quadratic"),
+    "adaptive": adaptive_iteration,
+}
+
+'''
+PageRank with a selectable solver (one of the keys of solvers);
+returns (pagerank, iterations, seconds spent in the solver)
+'''
+def compute_pageranks_solver(g, d, method="jacobi", epsilon=0.00001):
+    # g may also be an already compiled (nodes, M, dangling)
+    nodes, M, dangling = compile_graph(g) if isinstance(g, dict) else g
+    time1 = time.time()
+    p, iterations = solvers[method](M, dangling, d, epsilon)
+    time2 = time.time()
+    pagerank = {key: p[i] for i, key in enumerate(nodes)}
+    return pagerank, iterations, time2-time1
+
+def apply_route_changes(g, added=(), removed=()):
+    '''
+    Applies the edges in added and removed, given as (source, destination)
+    pairs, to g in place. Returns the previous destination list of every
+    source that was touched.
+    '''
+    old = {}
+    for src, dst in removed:
+        if src in g and dst in g[src]:
+            if src not in old:
+                old[src] = list(g[src])
+            g[src].remove(dst)
+    for src, dst in added:
+        if src not in g:
+            g[src] = []
+        if src not in old:
+            old[src] = list(g[src])
+        g[src].append(dst)
+    return old
+
+def _push_residuals(g, nodes, p, old, d, epsilon):
+    '''
+    Corrects p locally for the changed routes: the rank that the touched
+    sources now send differently becomes a residual, which is pushed
+    along the outgoing routes until every residual is below epsilon.
+    Residuals reaching dangling nodes are left for the power iteration.
+    '''
+    ids = {key: i for i, key in enumerate(nodes)}
+    residual = {}
+    for src, before in old.items():
+        share = d * p[ids[src]]
+        for adj in before:
+            residual[adj] = residual.get(adj, 0) - share/len(before)
+        for adj in g[src]:
+            residual[adj] = residual.get(adj, 0) + share/len(g[src])
+    pushes = 0
+    while residual and pushes < len(nodes):
+        node, r = residual.popitem()
+        if abs(r) <= epsilon or node not in ids:
+            continue
+        p[ids[node]] += r
+        adjs = g.get(node, [])
+        for adj in adjs:
+            residual[adj] = residual.get(adj, 0) + d*r/len(adjs)
+        pushes += 1
+    # residuals dropped below epsilon would otherwise leave a mass error
+    # that the power iteration only removes at rate d
+    return p / p.sum()
+
+'''
+Incremental PageRank: re-ranks g after a few routes were added and
+removed, warm-starting from the previous pageranks instead of 1/n
+'''
+def update_pageranks(g, d, previous, added=(), removed=(), push=False,
+                     epsilon=0.00001):
+    old = apply_route_changes(g, added, removed)
+    nodes, M, dangling = compile_graph(g)
+    n = len(nodes)
+    # new nodes start at 1/n, removed ones are dropped
+    p = np.array([previous.get(key, 1/n) for key in nodes])
+    p /= p.sum()
+    if push:
+        p = _push_residuals(g, nodes, p, old, d, epsilon)
+    p, iterations = sparse_power_iteration(M, dangling, d, epsilon, p)
+    pagerank = {key: p[i] for i, key in enumerate(nodes)}
+    return pagerank, iterations
+
+# arrays shared with the worker processes of parallel_power_iteration,
+# attached once per worker by _parallel_init
+_shared = {}
+
+def _share_array(a):
+    shm = SharedMemory(create=True, size=max(a.nbytes, 1))
+    view = np.ndarray(a.shape, dtype=a.dtype, buffer=shm.buf)
+    view[...] = a
+    return shm, (shm.name, a.shape, a.dtype.str)
+
+def _parallel_init(specs, d):
+    for name, (shm_name, shape, dtype) in specs.items():
+        shm = SharedMemory(name=shm_name)
+        _shared[name] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        _shared[name+"_shm"] = shm
+    _shared["d"] = d
+
+def _parallel_step(task):
+    '''
+    Computes rows lo:hi of pnew straight into shared memory and returns
+    this shard's part of the squared distance and of the dangling mass.
+    '''
+    lo, hi, parity, teleport = task
+    p = _shared["p"][parity]
+    pnew = _shared["p"][1-parity]
+    indptr = _shared["indptr"]
+    start, end = indptr[lo], indptr[hi]
+    # zero-copy view of the rows of M owned by this shard
+    M = sp.csr_matrix((_shared["data"][start:end],
+                       _shared["indices"][start:end],
+                       indptr[lo:hi+1]-start), shape=(hi-lo, len(p)))
+    pnew[lo:hi] = _shared["d"] * (M @ p) + teleport
+    diff = p[lo:hi]-pnew[lo:hi]
+    return diff @ diff, pnew[lo:hi][_shared["dangling"][lo:hi]].sum()
+
+def parallel_power_iteration(M, dangling, d, workers=None, epsilon=0.00001):
+    '''
+    Same iteration as sparse_power_iteration, with the rows of M split
+    into one shard per worker (balanced by rows + edges). M, dangling and
+    both rank vectors live in shared memory; every iteration the workers
+    fill their part of pnew and the distance is reduced over the shards.
+    '''
+    if workers is None:
+        workers = cpu_count()
+    n = M.shape[0]
+    M = M.tocsr()
+    cost = M.indptr + np.arange(n+1)
+    bounds = np.searchsorted(cost, np.linspace(0, cost[-1], workers+1))
+    bounds[0], bounds[-1] = 0, n
+    shards = [(lo, hi) for lo, hi in zip(bounds[:-1], bounds[1:]) if hi > lo]
+
+    p = np.zeros((2, n))
+    p[0] = 1/n
+    arrays = {"data": M.data, "indices": M.indices, "indptr": M.indptr,
+              "dangling": dangling, "p": p}
+    blocks, specs = [], {}
+    try:
+        for name, a in arrays.items():
+            shm, specs[name] = _share_array(a)
+            blocks.append(shm)
+        p = np.ndarray(p.shape, dtype=p.dtype, buffer=blocks[-1].buf)
+        with Pool(len(shards), _parallel_init, (specs, d)) as pool:
+            dist = 1
+            iterations = 0
+            parity = 0
+            dangling_mass = p[0][dangling].sum()
+            while dist > epsilon:
+                teleport = (d * dangling_mass + 1-d) / n
+                tasks = [(lo, hi, parity, teleport) for lo, hi in shards]
+                parts = pool.map(_parallel_step, tasks, chunksize=1)
+                dist = sqrt(sum(sq for sq, _ in parts))
+                dangling_mass = sum(mass for _, mass in parts)
+                parity = 1-parity
+                iterations += 1
+            result = p[parity].copy()
+    finally:
+        del p
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+    return result, iterations
+
+'''
+Multi-core implementation of PageRank: the compiled graph is sharded
+by rows across a pool of worker processes
+'''
+def compute_pageranks_parallel(g, d, workers=None, epsilon=0.00001):
+    nodes, M, dangling = compile_graph(g)
+    p, iterations = parallel_power_iteration(M, dangling, d, workers, epsilon)
+    pagerank = {key: p[i] for i, key in enumerate(nodes)}
+    return pagerank, iterations
+
+def write_edge_blocks(g, path, block_edges=1<<20):
+    '''
+    Writes the graph g to the directory path as fixed-width arrays that
+    compute_pageranks_disk can memory-map:
+      src.int32, dst.int32  one entry per edge, sorted by source id
+      outdeg.int32          outdegree of every node
+      nodes.txt             node keys as text, one per line, in id order
+    Edges are flushed every block_edges, so g may itself be disk-backed
+    (any mapping whose items() yields node -> list of destinations).
+    '''
+    os.makedirs(path, exist_ok=True)
+    ids = {key: index for index, key in enumerate(g.keys())}
+    extra = []
+    src, dst, outdeg = [], [], []
+    with open(os.path.join(path, "src.int32"), "wb") as fsrc, \
+         open(os.path.join(path, "dst.int32"), "wb") as fdst, \
+         open(os.path.join(path, "outdeg.int32"), "wb") as fdeg:
+        # keys are numbered in order, so edges come out sorted by source
+        for node, adjs in g.items():
+            i = ids[node]
+            for adj in adjs:
+                if adj not in ids:
+                    ids[adj] = len(ids)
+                    extra.append(adj)
+                src.append(i)
+                dst.append(ids[adj])
+            outdeg.append(len(adjs))
+            if len(src) >= block_edges:
+                np.array(src, dtype=np.int32).tofile(fsrc)
+                np.array(dst, dtype=np.int32).tofile(fdst)
+                src, dst = [], []
+        np.array(src, dtype=np.int32).tofile(fsrc)
+        np.array(dst, dtype=np.int32).tofile(fdst)
+        # destinations that are not keys of g have no outgoing edges
+        outdeg += [0] * len(extra)
+        np.array(outdeg, dtype=np.int32).tofile(fdeg)
+    with open(os.path.join(path, "nodes.txt"), "w", encoding="utf8") as fnodes:
+        for key in g.keys():
+            fnodes.write(str(key)+"\n")
+        for key in extra:
+            fnodes.write(str(key)+"\n")
+
+def open_edge_blocks(path):
+    '''
+    Memory-maps the arrays written by write_edge_blocks read-only and
+    returns (src, dst, outdeg).
+    '''
+    def load(name):
+        filename = os.path.join(path, name)
+        if os.path.getsize(filename) == 0:
+            return np.zeros(0, dtype=np.int32)
+        return np.memmap(filename, dtype=np.int32, mode="r")
+    return load("src.int32"), load("dst.int32"), load("outdeg.int32")
+
+def disk_power_iteration(path, d, epsilon=0.00001, block_edges=1<<22):
+    '''
+    Same iteration as sparse_power_iteration, but the edges stay on
+    disk: each iteration streams them in blocks of block_edges, so only
+    the rank vectors (and one block) are resident.
+    '''
+    src, dst, outdeg = open_edge_blocks(path)
+    n = len(outdeg)
+    m = len(src)
+    dangling = outdeg == 0
+    # 1/outdegree, 0 for dangling nodes (which never appear in src)
+    inv_outdeg = 1/np.maximum(outdeg, 1)
+    p = 1/n*np.ones(n)
+    dist = 1
+    iterations = 0
+    while dist > epsilon:
+        pnew = np.zeros(n)
+        share = d * p * inv_outdeg
+        for start in range(0, m, block_edges):
+            bsrc = src[start:start+block_edges]
+            bdst = dst[start:start+block_edges]
+            pnew += np.bincount(bdst, weights=share[bsrc], minlength=n)
+        pnew += (d * p[dangling].sum() + 1-d) / n
+        dist = np.linalg.norm(p-pnew)
+        p = pnew
+        iterations += 1
+    return p, iterations
+
+'''
+(Out-of-core) implementation of PageRank over the memory-mapped edge
+arrays written by write_edge_blocks
+'''
+def compute_pageranks_disk(path, d, epsilon=0.00001, block_edges=1<<22):
+    p, iterations = disk_power_iteration(path, d, epsilon, block_edges)
+    with open(os.path.join(path, "nodes.txt"), "r", encoding="utf8") as fnodes:
+        pagerank = {line[:-1]: p[i] for i, line in enumerate(fnodes)}
+    return pagerank, iterations
+
+def personalized_power_iteration(M, dangling, d, V, epsilon=0.00001):
+    '''
+    Personalized PageRank for every column of the n x s matrix V of
+    teleport distributions at once: each iteration is one sparse
+    mat-mat M @ P. Teleports and the rank of dangling nodes go to the
+    column's own distribution. Stops when the change of every column
+    is at most epsilon.
+    '''
+    P = V.copy()
+    dist = 1
+    iterations = 0
+    while dist > epsilon:
+        Pnew = d * (M @ P)
+        Pnew += (d * P[dangling].sum(axis=0) + 1-d) * V
+        dist = np.linalg.norm(P-Pnew, axis=0).max()
+        P = Pnew
+        iterations += 1
+    return P, iterations
+
+class PersonalizedPageRank(object):
+    '''
+    Personalized PageRank on a graph compiled once, for seed sets of
+    nodes (e.g. "important airports as seen from hub X"). Rank vectors
+    are kept in an LRU cache keyed by seed set.
+    '''
+
+    def __init__(self, g, d, cache_size=1024, block_size=256,
+                 epsilon=0.00001):
+        self.nodes, self.M, self.dangling = compile_graph(g)
+        self.ids = {key: i for i, key in enumerate(self.nodes)}
+        self.d = d
+        self.epsilon = epsilon
+        self.block_size = block_size
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+
+    def teleport_matrix(self, seed_sets):
+        ''' n x s matrix, column j uniform over seed_sets[j] (all nodes
+        if it is empty) '''
+        n = len(self.nodes)
+        V = np.zeros((n, len(seed_sets)))
+        for j, seeds in enumerate(seed_sets):
+            if seeds:
+                V[[self.ids[key] for key in seeds], j] = 1/len(seeds)
+            else:
+                V[:, j] = 1/n
+        return V
+
+    def pageranks(self, seed_sets):
+        '''
+        Returns (P, iterations): column j of the n x s matrix P is the
+        rank vector (in the order of self.nodes) for seed_sets[j].
+        Only the seed sets missing from the cache are computed, in
+        blocks of block_size; iterations is 0 if all of them were cached.
+        '''
+        keys = [frozenset(seeds) for seeds in seed_sets]
+        # take the hits out first, storing misses may evict them
+        found = {key: self._lookup(key) for key in keys if key in self._cache}
+        missing = list(OrderedDict.fromkeys(
+            key for key in keys if key not in found))
+        iterations = 0
+        for start in range(0, len(missing), self.block_size):
+            block = missing[start:start+self.block_size]
+            P, its = personalized_power_iteration(
+                self.M, self.dangling, self.d,
+                self.teleport_matrix(block), self.epsilon)
+            iterations = max(iterations, its)
+            for j, key in enumerate(block):
+                found[key] = P[:, j].copy()
+                self._store(key, found[key])
+        P = np.empty((len(self.nodes), len(keys)))
+        for j, key in enumerate(keys):
+            P[:, j] = found[key]
+        return P, iterations
+
+    def pagerank(self, seeds):
+        ''' rank dict for a single seed set '''
+        P, _ = self.pageranks([seeds])
+        return {key: P[i, 0] for i, key in enumerate(self.nodes)}
+
+    def _lookup(self, key):
+        self._cache.move_to_end(key)
+        return self._cache[key]
+
+    def _store(self, key, p):
+        self._cache[key] = p
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+def _source_stamp(filenames):
+    ''' Size and modification time of every file, to tell when a cache is stale '''
+    stamp = {}
+    for name in filenames:
+        st = os.stat(name)
+        # the same file is the same source, however its path is spelled
+        stamp[os.path.abspath(name)] = [st.st_size, st.st_mtime_ns]
+    return stamp
+
+def _publish_cache(tmp, cache):
+    ''' Moves every file of the directory tmp into the directory cache and removes tmp.
+    The files are renamed over the old ones rather than rewritten, so processes that
+    memory-mapped the old ones keep reading them '''
+    for name in os.listdir(tmp):
+        os.replace(os.path.join(tmp, name), os.path.join(cache, name))
+    os.rmdir(tmp)
+
+def load_airport_graph(airports="airports.txt", routes="routes.txt",
+                       cache="airports_graph"):
+    '''
+    Returns the airport graph compiled as (nodes, M, dangling), the same
+    as compile_graph(read_routes(read_airports(), remove_sinks=False)).
+    The first call parses the text files and stores the graph in the
+    directory cache, in the format of write_edge_blocks; later calls
+    memory-map it until the size or mtime of a source file changes.
+    '''
+    stamp = _source_stamp([airports, routes])
+    stampfile = os.path.join(cache, "source.json")
+    try:
+        with open(stampfile, "r") as f:
+            fresh = json.load(f) == stamp
+    except (OSError, ValueError):
+        fresh = False
+    if not fresh:
+        airp = read_airports(airports)
+        g = read_routes(airp, remove_sinks=False, filename=routes)
+        os.makedirs(cache, exist_ok=True)
+        if os.path.exists(stampfile):
+            os.remove(stampfile)
+        tmp = tempfile.mkdtemp(dir=cache)
+        write_edge_blocks(g, tmp)
+        _publish_cache(tmp, cache)
+        # written last, so an interrupted write is never taken as fresh
+        with open(stampfile, "w") as f:
+            json.dump(stamp, f)
+    src, dst, outdeg = open_edge_blocks(cache)
+    with open(os.path.join(cache, "nodes.txt"), "r", encoding="utf8") as fnodes:
+        nodes = [line[:-1] for line in fnodes]
+    M, dangling = transition_matrix(src, dst, len(nodes))
+    return nodes, M, dangling
+
 def output_pageranks(l):
     l = [(key,val) for key,val in l.items()]
     # sort decreasingly by rank
@@ -112,22 +742,25 @@ def output_pageranks(l):
 def rank_simple_graph():
     damping_factor = 1  # to get the slide example. Change
     time1 = time.time()
-    pageranks, iterations = compute_pageranks(simple_graph,damping_factor)
+    pageranks, iterations = compute_pageranks_sparse(simple_graph,damping_factor)
     time2 = time.time()
     output_pageranks(pageranks)
     print("#Iterations:", iterations)
     print("Time to computePageRanks():", time2-time1)
 
-def rank_airports():
+def rank_airports(method="jacobi"):
     damping_factor = 0.85  # Change
-    airp = read_airports()
-    routes = read_routes(airp)
     time1 = time.time()
-    pageranks, iterations = compute_pageranks(routes,damping_factor)
+    graph = load_airport_graph()
     time2 = time.time()
+    print(len(graph[0]), "airports loaded in", time2-time1)
+    pageranks, iterations, seconds = compute_pageranks_solver(
+        graph, damping_factor, method)
     output_pageranks(pageranks)
-    print("#Iterations:", iterations)
-    print("Time to compute PageRanks():", time2-time1)
+    print("#Iterations:", iterations, "("+method+")")
+    print("Time to compute PageRanks():", seconds)
 
-# rank_simple_graph()
-rank_airports()
+if __name__ == "__main__":
+    # rank_simple_graph()
+    # optional argument: solver, one of the keys of solvers
+    rank_airports(*sys.argv[1:2])
@@ -0,0 +1,150 @@
+#!/usr/bin/python
+
+'''
+Scaling benchmark for the PageRank implementations in PageRank.py.
+
+Runs every implementation on simple_graph, on the airports graph (when
+airports.txt and routes.txt are in the current directory) and on
+reproducible synthetic graphs with power-law out-degree, and writes
+iterations, wall time, peak memory and edges/sec to a JSON report.
+'''
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import scipy
+
+import PageRank as pr
+
+def power_law_graph(edges, exponent=1.0, degree=8, seed=0):
+    '''
+    Synthetic graph with 'edges' edges over edges/degree nodes. Sources
+    and destinations are drawn with probability proportional to
+    rank^-exponent (on two different orderings of the nodes), so both
+    out- and in-degrees follow a power law. The same (edges, seed)
+    always gives the same graph.
+    '''
+    rng = np.random.default_rng(seed)
+    n = max(edges // degree, 2)
+    w = np.arange(1, n+1, dtype=float) ** -exponent
+    w /= w.sum()
+    src = np.sort(rng.choice(n, size=edges, p=w))
+    dst = rng.permutation(n)[rng.choice(n, size=edges, p=w)]
+    indptr = np.searchsorted(src, np.arange(n+1))
+    return {i: dst[indptr[i]:indptr[i+1]].tolist() for i in range(n)}
+
+def run_disk(g, d):
+    with tempfile.TemporaryDirectory() as path:
+        pr.write_edge_blocks(g, path)
+        return pr.compute_pageranks_disk(path, d)
+
+def implementations(workers):
+    '''
+    name -> function(g, d) returning (pagerank, iterations)
+    '''
+    impls = {
+        "dict": pr.compute_pageranks,
+        "sparse": pr.compute_pageranks_sparse,
+        "disk": run_disk,
+        "parallel": lambda g, d: pr.compute_pageranks_parallel(g, d, workers),
+    }
+    for method in pr.solvers:
+        impls["solver:"+method] = (lambda method: lambda g, d:
+            pr.compute_pageranks_solver(g, d, method)[:2])(method)
+    return impls
+
+def graphs(args):
+    '''
+    Yields (name, graph) for every graph in the benchmark
+    '''
+    yield "simple_graph", pr.simple_graph
+    if os.path.exists("airports.txt") and os.path.exists("routes.txt"):
+        # sinks removed, so that the dict implementation can run on it
+        yield "airports", pr.read_routes(pr.read_airports())
+    edges = args.min_edges
+    while edges <= args.max_edges:
+        yield "power_law_%d" % edges, power_law_graph(edges, seed=args.seed)
+        edges *= 10
+
+def measure(function, g, d, repeat):
+    '''
+    Best wall time of 'repeat' runs, plus one run under tracemalloc for
+    the peak of Python and numpy allocations (worker processes and
+    memory-mapped pages are not included).
+    '''
+    best = None
+    for _ in range(repeat):
+        time1 = time.perf_counter()
+        _, iterations = function(g, d)
+        time2 = time.perf_counter()
+        if best is None or time2-time1 < best:
+            best = time2-time1
+    tracemalloc.start()
+    function(g, d)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return iterations, best, peak
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--min-edges', default=10**3, type=int)
+    parser.add_argument('--max-edges', default=10**7, type=int)
+    parser.add_argument('--dict-max-edges', default=10**5, type=int,
+                        help='largest graph to run the pure-Python dict implementation on')
+    parser.add_argument('--only', nargs='*', default=None,
+                        help='implementations to run (default: all)')
+    parser.add_argument('--workers', default=None, type=int)
+    parser.add_argument('--repeat', default=1, type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('-d', default=0.85, type=float)
+    parser.add_argument('-o', '--output', default='pagerank_bench.json')
+    args = parser.parse_args()
+
+    impls = implementations(args.workers)
+    if args.only:
+        impls = {name: impls[name] for name in args.only}
+
+    results = []
+    for graph_name, g in graphs(args):
+        nodes = len(pr.index_graph(g)[0])
+        edges = sum(len(adjs) for adjs in g.values())
+        for name, function in impls.items():
+            if name == "dict" and edges > args.dict_max_edges:
+                continue
+            # the slide example is ranked with d = 1, as in rank_simple_graph
+            d = 1 if graph_name == "simple_graph" else args.d
+            iterations, seconds, peak = measure(function, g, d, args.repeat)
+            results.append({
+                "graph": graph_name,
+                "nodes": nodes,
+                "edges": edges,
+                "implementation": name,
+                "damping": d,
+                "iterations": iterations,
+                "seconds": seconds,
+                "peak_bytes": peak,
+                "edges_per_sec": edges * iterations / seconds if seconds > 0 else None,
+            })
+            print("%-16s %-20s %4d it %10.4f s %12d B" %
+                  (graph_name, name, iterations, seconds, peak))
+
+    report = {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "scipy": scipy.__version__,
+        "cpus": os.cpu_count(),
+        "seed": args.seed,
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print("report written to", args.output)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,8 +6,13 @@ Simple module implementing LSH
 from __future__ import print_function, division
 import numpy
 import sys
+import os
+import json
 import argparse
+import heapq
+import itertools
 import time
+from multiprocessing import Pool
 
 __version__ = '0.2.1'
 __author__ = 'marias@cs.upc.edu'
@@ -25,6 +30,142 @@ def timeit(method):
 
     return timed
 
+class BucketTable(object):
+    """
+    one hash table in CSR layout: keys are the distinct codes, sorted, and
+    the bucket of keys[j] is members[offsets[j]:offsets[j+1]]. Supports
+    the dict operations used on the tables (in, [], get, len, items), and
+    works the same on in-memory and memory-mapped arrays. Images added
+    later go to the dict extra until the table is compacted.
+    """
+
+    def __init__(self, keys, offsets, members):
+        self.keys = keys
+        self.offsets = offsets
+        self.members = members
+        # inserted since the last compaction: code -> list of ids
+        self.extra = {}
+        # query counters: codes looked up, and how many hit no bucket
+        self.lookups = 0
+        self.empty_probes = 0
+
+    @classmethod
+    def from_codes(cls, codes, ids):
+        """ table of the images ids with hash codes codes """
+        # stable, so every bucket stays in index order
+        order = numpy.argsort(codes, kind='stable')
+        keys, starts = numpy.unique(codes[order], return_index=True)
+        offsets = numpy.append(starts, len(codes)).astype(numpy.int64)
+        return cls(keys, offsets, numpy.asarray(ids, dtype=numpy.int32)[order])
+
+    def lookup(self, codes):
+        """ (start, end) offsets into members of the bucket of every code,
+        with start == end for codes that are not in the table """
+        codes = numpy.asarray(codes, dtype=numpy.uint64)
+        if len(self.keys) == 0:
+            zero = numpy.zeros(codes.shape, dtype=numpy.int64)
+            return zero, zero
+        pos = numpy.minimum(numpy.searchsorted(self.keys, codes),
+                            len(self.keys) - 1)
+        hit = self.keys[pos] == codes
+        start = numpy.where(hit, self.offsets[pos], 0)
+        end = numpy.where(hit, self.offsets[pos + 1], 0)
+        return start, end
+
+    def buckets(self, codes):
+        """ the bucket of every code (empty if it is not in the table),
+        including the images added since the last compaction """
+        start, end = self.lookup(codes)
+        res = [self.members[s:e] for s, e in zip(start.tolist(), end.tolist())]
+        if self.extra:
+            codes = numpy.asarray(codes, dtype=numpy.uint64).tolist()
+            for j, code in enumerate(codes):
+                if code in self.extra:
+                    res[j] = numpy.append(res[j], self.extra[code])
+        self.lookups += len(res)
+        self.empty_probes += sum(1 for bucket in res if len(bucket) == 0)
+        return res
+
+    def get(self, code, default=None):
+        bucket = self.buckets([code])[0]
+        if len(bucket) == 0:
+            return default
+        return bucket
+
+    def add(self, codes, ids):
+        """ insert the images ids with hash codes codes """
+        for code, idx in zip(codes.tolist(), ids.tolist()):
+            self.extra.setdefault(code, []).append(idx)
+
+    def size(self):
+        """ number of image ids stored, tombstones included """
+        return len(self.members) + sum(len(ids) for ids in self.extra.values())
+
+    def compact(self, deleted):
+        """ new table with the added images merged in and the ids marked
+        in the boolean array deleted left out """
+        codes = numpy.repeat(self.keys, numpy.diff(self.offsets))
+        ids = numpy.asarray(self.members, dtype=numpy.int64)
+        if self.extra:
+            codes = numpy.append(codes, numpy.array(
+                [code for code, idx in self.extra.items() for _ in idx],
+                dtype=numpy.uint64))
+            ids = numpy.append(ids, [i for idx in self.extra.values() for i in idx])
+        keep = ~deleted[ids]
+        table = BucketTable.from_codes(codes[keep], ids[keep])
+        table.lookups, table.empty_probes = self.lookups, self.empty_probes
+        return table
+
+    def stats(self, top=5):
+        """ bucket occupancy of the table: number of buckets and images,
+        histogram of bucket sizes as [size, nr. of buckets] pairs, the top
+        largest buckets as [code, size] pairs, and the query counters """
+        sizes = numpy.diff(self.offsets)
+        keys = self.keys.tolist()
+        if self.extra:
+            merged = dict(zip(keys, sizes.tolist()))
+            for code, ids in self.extra.items():
+                merged[code] = merged.get(code, 0) + len(ids)
+            keys = list(merged)
+            sizes = numpy.array(list(merged.values()), dtype=numpy.int64)
+        histogram = numpy.bincount(sizes) if len(sizes) else numpy.zeros(0)
+        largest = numpy.argsort(-sizes, kind='stable')[:top]
+        return {
+            'buckets': len(sizes),
+            'images': int(sizes.sum()),
+            'size_histogram': [[size, int(count)] for size, count
+                               in enumerate(histogram) if count],
+            'largest': [[keys[j], int(sizes[j])] for j in largest],
+            'lookups': self.lookups,
+            'empty_probes': self.empty_probes,
+        }
+
+    def __getitem__(self, code):
+        bucket = self.get(code)
+        if bucket is None:
+            raise KeyError(code)
+        return bucket
+
+    def __contains__(self, code):
+        # not counted as a lookup: get or [] usually follows
+        start, end = self.lookup([code])
+        return bool(start[0] != end[0]) or int(code) in self.extra
+
+    def __len__(self):
+        start, end = self.lookup(list(self.extra))
+        return len(self.keys) + int(numpy.sum(start == end))
+
+    def items(self):
+        for j, key in enumerate(self.keys.tolist()):
+            bucket = self.members[self.offsets[j]:self.offsets[j + 1]]
+            if key in self.extra:
+                bucket = numpy.append(bucket, self.extra[key])
+            yield key, bucket
+        start, end = self.lookup(list(self.extra))
+        for (key, ids), s, e in zip(self.extra.items(), start, end):
+            if s == e:
+                yield key, numpy.array(ids)
+
 class lsh(object):
     """
     implements lsh for digits database in file 'images.npy'
@@ -32,6 +173,9 @@ class lsh(object):
 
     def __init__(self, k, m):
         """ k is nr. of bits to hash and m is reapeats """
+        # hash codes are packed into 64-bit integers
+        if k > 64:
+            raise ValueError("k must be at most 64, got %d" % k)
         # data is numpy ndarray with images
         self.data = numpy.load('images.npy')
         self.k = k
@@ -48,115 +192,529 @@ class lsh(object):
         # will place these into an m x k numpy array
         numpy.random.seed(12345)
         self.hashbits = numpy.random.randint(self.imlen, size=(m, k))
+        self._init_bits()
 
         # the following stores the hashed images
-        # in a python list of m dictionaries (one for each repeat)
-        self.hashes = [dict() for _ in range(self.m)]
+        # in a python list of m tables (one for each repeat)
+        self.hashes = [None] * self.m
+
+        # tombstones: removed images stay in the tables until compact()
+        self.deleted = numpy.zeros(len(self.data), dtype=bool)
+        self.tombstones = 0
+        # compact when tombstones exceed this fraction of the indexed images
+        self.autocompact = 0.25
+        self._init_added()
 
         # now, fill it out
         self.hash_all_images()
 
         return
 
+    def _init_bits(self):
+        """ split hashbits into the pixel and the unary-code index of
+        every bit, and the position of every bit in the packed code """
+        self._bitpix = self.hashbits // self.maxval
+        self._bitnum = self.hashbits % self.maxval
+        # first bit is the most significant one, so a code is the
+        # integer value of the bit string 'b_0 b_1 ... b_(k-1)'
+        self._shifts = numpy.arange(self.k - 1, -1, -1, dtype=numpy.uint64)
+
+    def _init_added(self):
+        """ images inserted by add_images live in a buffer with spare room
+        until compact() merges them into data, so that inserting does not
+        copy data (nor read it into memory if it is memory-mapped) """
+        self._added = numpy.empty((0,) + self.data.shape[1:], dtype=self.data.dtype)
+        self._nadded = 0
+
+    def _grow(self, n):
+        """ make room for n more added images. Buffers double when full,
+        so streaming images one at a time costs amortized O(1) per image """
+        if self._nadded + n > len(self._added):
+            added = numpy.empty((max(2 * len(self._added), self._nadded + n),)
+                                + self.data.shape[1:], dtype=self.data.dtype)
+            added[:self._nadded] = self._added[:self._nadded]
+            self._added = added
+        total = len(self.data) + self._nadded + n
+        if total > len(self.deleted):
+            size = max(2 * len(self.deleted), total)
+            # slots past the last image are neither indexed nor deleted
+            for name in ('deleted', 'indexed'):
+                flags = numpy.zeros(size, dtype=bool)
+                flags[:len(getattr(self, name))] = getattr(self, name)
+                setattr(self, name, flags)
+
+    def _images(self, ids):
+        """ flattened images with indices ids, from data or the added ones """
+        flat = self.data.reshape(len(self.data), -1)
+        ids = numpy.asarray(ids)
+        if not self._nadded:
+            return flat[ids]
+        out = numpy.empty((len(ids), flat.shape[1]), dtype=self.data.dtype)
+        base = ids < len(self.data)
+        out[base] = flat[ids[base]]
+        out[~base] = self._added[ids[~base] - len(self.data)].reshape(-1, flat.shape[1])
+        return out
+
     def hash_all_images(self):
         """ go through all images and store them in hash table(s) """
         # Achtung!
         # Only hashing the first 1500 images, the rest are used for testing
-        for idx, im in enumerate(self.data[:1500]):
-            for i in range(self.m):
-                str = self.hashcode(im, i)
-
-                # store it into the dictionary..
-                # (well, the index not the whole array!)
-                if str not in self.hashes[i]:
-                    self.hashes[i][str] = []
-                self.hashes[i][str].append(idx)
+        codes = self.hashcodes(self.data[:1500])
+        ids = numpy.arange(len(codes))
+        # which images are in the tables (tombstoned ones included)
+        self.indexed = numpy.zeros(len(self.data), dtype=bool)
+        self.indexed[ids] = True
+        for i in range(self.m):
+            self.hashes[i] = BucketTable.from_codes(codes[:, i], ids)
         return
 
+    def table_stats(self, top=5):
+        """ BucketTable.stats of every table """
+        return [table.stats(top) for table in self.hashes]
+
+    def index_bytes(self):
+        """ memory taken by the hash functions and the tables """
+        return self.hashbits.nbytes + sum(
+            table.keys.nbytes + table.offsets.nbytes + table.members.nbytes
+            for table in self.hashes)
+
+    def add_images(self, images):
+        """ append images (one, or a batch) to the data and insert them in
+        every table; returns their indices """
+        images = numpy.asarray(images, dtype=self.data.dtype)
+        images = images.reshape((-1,) + self.data.shape[1:])
+        self._grow(len(images))
+        ids = numpy.arange(len(images)) + len(self.data) + self._nadded
+        self._added[self._nadded:self._nadded + len(images)] = images
+        self._nadded += len(images)
+        self.indexed[ids] = True
+        codes = self.hashcodes(images)
+        for i, table in enumerate(self.hashes):
+            table.add(codes[:, i], ids)
+        return ids
+
+    def remove_images(self, ids):
+        """ remove the images with indices ids from the index. They are
+        only marked as deleted (and no longer returned by queries) until
+        the tables are compacted """
+        ids = numpy.atleast_1d(ids)
+        # the flags have spare room past the last image (see _grow)
+        total = len(self.data) + self._nadded
+        if numpy.any((ids < -total) | (ids >= total)):
+            raise IndexError("image indices must be in [0, %d)" % total)
+        ids = ids % total
+        # only images in the tables leave a tombstone there
+        ids = numpy.unique(ids)
+        self.tombstones += int(numpy.sum(self.indexed[ids] & ~self.deleted[ids]))
+        self.deleted[ids] = True
+        if self.tombstones > self.autocompact * self.hashes[0].size():
+            self.compact()
+
+    def compact(self):
+        """ rebuild the tables with the added images merged in and the
+        removed ones dropped (indices of the other images do not change) """
+        self.hashes = [table.compact(self.deleted) for table in self.hashes]
+        self.tombstones = 0
+        if self._nadded:
+            self.data = numpy.concatenate((self.data, self._added[:self._nadded]))
+            self._init_added()
+
+    def save(self, path):
+        """ store the index in directory path: hashbits, the images and
+        every table as its keys, offsets and members arrays. Pending
+        insertions and removals are compacted first """
+        if self.tombstones or self._nadded or self.hashes[0].extra:
+            self.compact()
+        os.makedirs(path, exist_ok=True)
+        # every file is written aside and renamed into place, so that saving
+        # over the index this one was loaded from does not truncate the files
+        # its arrays are memory-mapped from
+        def replace(name, write):
+            filename = os.path.join(path, name)
+            with open(filename + '.tmp', 'wb') as f:
+                write(f)
+            os.replace(filename + '.tmp', filename)
+        def array(name, a):
+            replace(name + '.npy', lambda f: numpy.save(f, a))
+        array('hashbits', self.hashbits)
+        array('images', self.data)
+        for i, table in enumerate(self.hashes):
+            for name in ('keys', 'offsets', 'members'):
+                array('table%d_%s' % (i, name), getattr(table, name))
+        meta = {'version': __version__, 'k': self.k, 'm': self.m,
+                'pixels': self.pixels, 'maxval': self.maxval}
+        replace('index.json', lambda f: f.write(json.dumps(meta).encode()))
+
+    @classmethod
+    def load(cls, path):
+        """ open an index stored by save. All arrays are memory-mapped
+        read-only, so processes opening the same index share its pages
+        and can answer queries without building anything """
+        with open(os.path.join(path, 'index.json')) as f:
+            meta = json.load(f)
+        def array(name):
+            return numpy.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+        self = cls.__new__(cls)
+        self.k, self.m = meta['k'], meta['m']
+        self.pixels, self.maxval = meta['pixels'], meta['maxval']
+        self.imlen = self.pixels * self.maxval
+        self.data = array('images')
+        self.hashbits = numpy.asarray(array('hashbits'))
+        self._init_bits()
+        self.hashes = [BucketTable(*[array('table%d_%s' % (i, name))
+                                     for name in ('keys', 'offsets', 'members')])
+                       for i in range(self.m)]
+        self.deleted = numpy.zeros(len(self.data), dtype=bool)
+        self.indexed = numpy.zeros(len(self.data), dtype=bool)
+        self.indexed[self.hashes[0].members] = True
+        self.tombstones = 0
+        self.autocompact = 0.25
+        self._init_added()
+        return self
+
+    def hashcodes(self, images, margins=False):
+        """ get all m hash codes of every image, as an (n, m) uint64 array.
+        With margins=True, also return the (n, m, k) array of how far each
+        pixel is from flipping its bit (small = least confident bit) """
+        pixels = numpy.asarray(images).reshape(-1, self.pixels)
+        # bit j of code i is 1 iff its unary index is <= its pixel value
+        gathered = pixels[:, self._bitpix]
+        bits = self._bitnum <= gathered
+        codes = bits.astype(numpy.uint64) << self._shifts
+        codes = numpy.bitwise_or.reduce(codes, axis=2)
+        if margins:
+            return codes, numpy.abs(gathered - self._bitnum + 0.5)
+        return codes
+
+    def probe_sequence(self, codes, margins):
+        """ given the m codes and margins of one image, yield (i, code) for
+        the codes of table i with some bits flipped, by increasing sum of
+        the margins of the flipped bits (query-directed multi-probe) """
+        # flip candidates of every table, least confident bit first
+        order = numpy.argsort(margins, axis=1)
+        z = numpy.take_along_axis(margins, order, axis=1).tolist()
+        masks = (numpy.uint64(1) << self._shifts[order]).tolist()
+        codes = [int(code) for code in codes]
+
+        # heap of (score, table, positions in order of the flipped bits)
+        heap = [(z[i][0], i, (0,)) for i in range(self.m)]
+        heapq.heapify(heap)
+        while heap:
+            score, i, flips = heapq.heappop(heap)
+            mask = 0
+            for j in flips:
+                mask |= masks[i][j]
+            yield i, codes[i] ^ mask
+            last = flips[-1]
+            if last + 1 < self.k:
+                # shift: flip the next bit instead of the last one
+                heapq.heappush(heap, (score - z[i][last] + z[i][last + 1],
+                                      i, flips[:-1] + (last + 1,)))
+                # expand: flip the next bit as well
+                heapq.heappush(heap, (score + z[i][last + 1],
+                                      i, flips + (last + 1,)))
+
+    def probed_buckets(self, codes, margins, probes, found=True):
+        """ the non-empty buckets among the first probes codes of
+        probe_sequence. If found is False (no exact bucket matched),
+        probing goes on until some bucket is non-empty """
+        sequence = self.probe_sequence(codes, margins)
+        # the budget is looked up with one searchsorted per table
+        first = [[] for _ in range(self.m)]
+        for i, code in itertools.islice(sequence, probes):
+            first[i].append(code)
+        buckets = []
+        for table, probed in zip(self.hashes, first):
+            buckets += [bucket for bucket in table.buckets(probed) if len(bucket)]
+        if not buckets and not found:
+            for i, code in itertools.islice(sequence, self.m * self.k * self.k):
+                bucket = self.hashes[i].get(code)
+                if bucket is not None:
+                    buckets.append(bucket)
+                    break
+        return buckets
+
     def hashcode(self, im, i):
         """ get the i'th hash code of image im (0 <= i < m)"""
-        pixels = im.flatten()
-        row = self.hashbits[i]
-        str = ""
-        for x in row:
-            # get bit corresponding to x from image..
-            pix = int(x) // int(self.maxval) # El pixel en el que esta el bit.
-            num = x % self.maxval #Index del bit dins del pixel.
-            if num <= pixels[pix]:
-                str += '1'
-            else:
-                str += '0'
-        return str
-
-    def candidates(self, im):
-        """ given image im, return matching candidates (well, the indices) """
+        return int(self.hashcodes(im)[0, i])
+
+    def candidates(self, im, probes=0):
+        """ given image im, return matching candidates (well, the indices),
+        also looking in probes nearby buckets """
         res = set()
+        codes, margins = self.hashcodes(im, margins=True)
         for i in range(self.m):
-            code = self.hashcode(im, i)
-            if code in self.hashes[i]:
-                res.update(self.hashes[i][code])
-        return res
+            bucket = self.hashes[i].get(int(codes[0, i]))
+            if bucket is not None:
+                res.update(bucket)
+        if probes:
+            for bucket in self.probed_buckets(codes[0], margins[0], probes,
+                                              found=len(res) > 0):
+                res.update(bucket)
+        return {idx for idx in res if not self.deleted[idx]}
 
     """Compares an image with images 'THAT MATCH WITH THE LSH' in the TR dataset."""
     @timeit
-    def lsh_search(self, im):
-        cand_set = self.candidates(im)
-        minDist = numpy.inf
-        index_nn = None
-
-        for cand in cand_set:
-            dist = distance(im, self.data[cand])
-            if dist < minDist:
-                minDist = dist
-                index_nn = cand
-
-        return (index_nn, minDist)
+    def lsh_search(self, im, probes=0, fallback=False):
+        nn, dist = self.lsh_search_many(im, 1, probes, fallback)
+        if nn[0, 0] < 0:
+            return (None, numpy.inf)
+        return (int(nn[0, 0]), dist[0, 0])
+
+    def lsh_search_many(self, images, topk=1, probes=0, fallback=False,
+                        stats=False):
+        """ given a batch of images, return the indices and l1 distances of
+        the topk nearest candidates of each one, as two (n, topk) arrays
+        sorted by distance (-1 and inf where there are fewer candidates).
+        With probes > 0, candidates also come from that many nearby buckets
+        (see probed_buckets). With fallback=True, images without any
+        candidate get their exact neighbours from knn_search instead.
+        With stats=True, also return a list with a dict per image: the
+        candidates scanned, the duplicates among the buckets of all tables,
+        the non-empty buckets, and the seconds spent hashing and looking up
+        buckets (including its share of the batch) and re-ranking """
+        ts = time.perf_counter()
+        images = numpy.asarray(images).reshape(-1, self.pixels)
+        codes, margins = self.hashcodes(images, margins=True)
+        # bucket of every query in every table
+        tables = [table.buckets(codes[:, i]) for i, table in enumerate(self.hashes)]
+        hash_sec = (time.perf_counter() - ts) / max(len(images), 1)
+
+        nn = numpy.full((len(images), topk), -1)
+        dist = numpy.full((len(images), topk), numpy.inf)
+        missed = []
+        query_stats = []
+        for q, im in enumerate(images):
+            ts = time.perf_counter()
+            buckets = [table[q] for table in tables]
+            if probes:
+                found = any(len(bucket) for bucket in buckets)
+                buckets += self.probed_buckets(codes[q], margins[q], probes, found)
+            entries = numpy.concatenate(buckets)
+            cand = numpy.unique(entries)
+            if stats:
+                te = time.perf_counter()
+                query_stats.append({
+                    'candidates': len(cand),
+                    'duplicates': len(entries) - len(cand),
+                    'buckets': sum(1 for bucket in buckets if len(bucket)),
+                    'hash_sec': hash_sec + te - ts,
+                })
+                ts = te
+            cand = cand[~self.deleted[cand]]
+            if len(cand) == 0:
+                missed.append(q)
+                if stats:
+                    query_stats[-1]['rerank_sec'] = 0.
+                continue
+            # l_1 distances to all candidates at once
+            d = numpy.abs(self._images(cand) - im).sum(axis=1)
+            if len(cand) > topk:
+                part = numpy.argpartition(d, topk - 1)[:topk]
+                cand, d = cand[part], d[part]
+            # by distance, then by index
+            order = numpy.lexsort((cand, d))
+            nn[q, :len(order)] = cand[order]
+            dist[q, :len(order)] = d[order]
+            if stats:
+                query_stats[-1]['rerank_sec'] = time.perf_counter() - ts
+
+        if fallback and missed:
+            ts = time.perf_counter()
+            live = numpy.flatnonzero(self.indexed & ~self.deleted)
+            exact, exact_dist = knn_search(images[missed], self._images(live), topk)
+            nn[missed] = numpy.where(exact < 0, -1, live[exact])
+            dist[missed] = exact_dist
+            if stats:
+                for q in missed:
+                    query_stats[q]['candidates'] = len(live)
+                    query_stats[q]['rerank_sec'] = (time.perf_counter() - ts) / len(missed)
+        if stats:
+            return nn, dist, query_stats
+        return nn, dist
 
 
 """Distance function between two images."""
 def distance(im1, im2):
-    pixels1 = im1.flatten()
-    pixels2 = im2.flatten()
-
-    dist = 0
-    for p in range(len(pixels1)):
-        dist += numpy.abs(pixels1[p]-pixels2[p]) # l_1 distance!
-
-    return dist
+    return numpy.abs(im1.flatten() - im2.flatten()).sum() # l_1 distance!
+
+# data searched by the worker processes of knn_search
+_knn_data = None
+
+def _knn_init(data):
+    global _knn_data
+    _knn_data = data
+
+def _knn_shard(task):
+    queries, topk, max_bytes = task
+    return _knn_blocks(queries, _knn_data, topk, max_bytes)
+
+def _knn_blocks(queries, data, topk, max_bytes):
+    """ knn_search on one process: queries are taken in blocks of up to 64
+    and data in blocks small enough for a distance tile of max_bytes """
+    n, dim = queries.shape
+    qb = max(1, min(n, 64))
+    db = max(1, max_bytes // (qb * dim * 8))
+    nn = numpy.full((n, topk), -1)
+    dist = numpy.full((n, topk), numpy.inf)
+    for qs in range(0, n, qb):
+        q = queries[qs:qs + qb]
+        best = numpy.empty((len(q), 0), dtype=numpy.int64)
+        best_dist = numpy.empty((len(q), 0))
+        for ds in range(0, len(data), db):
+            block = data[ds:ds + db]
+            d = numpy.abs(q[:, None, :] - block[None, :, :]).sum(axis=2)
+            idx = numpy.broadcast_to(numpy.arange(ds, ds + len(block)), d.shape)
+            # the best so far come first and have lower indices, so a
+            # stable sort breaks ties by index
+            d = numpy.hstack((best_dist, d))
+            idx = numpy.hstack((best, idx))
+            order = numpy.argsort(d, axis=1, kind='stable')[:, :topk]
+            best = numpy.take_along_axis(idx, order, axis=1)
+            best_dist = numpy.take_along_axis(d, order, axis=1)
+        nn[qs:qs + qb, :best.shape[1]] = best
+        dist[qs:qs + qb, :best.shape[1]] = best_dist
+    return nn, dist
+
+def knn_search(queries, data, topk=1, max_bytes=1 << 26, workers=1):
+    """ exact topk nearest neighbours (l_1) of every query among the images
+    in data, as two (n, topk) arrays of indices and distances sorted by
+    distance, then index (-1 and inf if data has fewer than topk images).
+    Distances are computed tile by tile, each at most max_bytes; with
+    workers > 1 the queries are split over a pool of processes """
+    data = numpy.asarray(data)
+    data = data.reshape(len(data), -1)
+    queries = numpy.asarray(queries).reshape(-1, data.shape[1])
+    if workers <= 1 or len(queries) < 2:
+        return _knn_blocks(queries, data, topk, max_bytes)
+    shards = numpy.array_split(queries, workers)
+    with Pool(workers, _knn_init, (data,)) as pool:
+        parts = pool.map(_knn_shard, [(shard, topk, max_bytes) for shard in shards])
+    return (numpy.concatenate([nn for nn, _ in parts]),
+            numpy.concatenate([dist for _, dist in parts]))
 
 """Compares an image with all images in the TR dataset."""
 @timeit
 def bf_search(image, medata):
-    minDist = numpy.inf
-    index_nn = None
-
-    for i, tr_image in enumerate(medata):
-        dist = distance(image, tr_image)
-        if dist < minDist:
-            minDist = dist
-            index_nn = i
-
-    return (index_nn, minDist)
+    nn, dist = knn_search(image, medata, 1)
+    if nn[0, 0] < 0:
+        return (None, numpy.inf)
+    return (int(nn[0, 0]), dist[0, 0])
+
+def tune(ks, ms, probes=0):
+    """ builds an index for every (k, m) in the grid and measures it on the
+    held-out images (1500 onwards): recall@1 against the exact nearest
+    neighbour, average candidate-set size, per-query latency percentiles
+    (ms), build time (s) and index memory (bytes). Returns one dict per
+    configuration, with 'pareto' set on the Pareto-optimal ones (no other
+    configuration is at least as good in recall, p95 latency and memory,
+    and better in one) """
+    results = []
+    queries, exact = None, None
+    for k in ks:
+        for m in ms:
+            ts = time.time()
+            me = lsh(k, m)
+            build = time.time() - ts
+            if queries is None:
+                queries = me.data[1500:].reshape(-1, me.pixels)
+                exact = knn_search(queries, me.data[:1500], 1)[1][:, 0]
+
+            latencies, found, ncand = [], [], []
+            for q in queries:
+                ts = time.perf_counter()
+                nn, dist = me.lsh_search_many(q, 1, probes)
+                latencies.append(time.perf_counter() - ts)
+                found.append(dist[0, 0])
+                ncand.append(len(me.candidates(q, probes)))
+            p50, p95, p99 = numpy.percentile(latencies, [50, 95, 99]) * 1000
+            results.append({
+                'k': k, 'm': m, 'probes': probes,
+                'recall_at_1': float(numpy.mean(numpy.array(found) <= exact)),
+                'avg_candidates': float(numpy.mean(ncand)),
+                'latency_p50_ms': p50, 'latency_p95_ms': p95,
+                'latency_p99_ms': p99,
+                'build_sec': build,
+                'index_bytes': int(me.index_bytes()),
+            })
+
+    def dominates(a, b):
+        better_or_equal = (a['recall_at_1'] >= b['recall_at_1'] and
+                           a['latency_p95_ms'] <= b['latency_p95_ms'] and
+                           a['index_bytes'] <= b['index_bytes'])
+        return better_or_equal and (a['recall_at_1'] > b['recall_at_1'] or
+                                    a['latency_p95_ms'] < b['latency_p95_ms'] or
+                                    a['index_bytes'] < b['index_bytes'])
+    for r in results:
+        r['pareto'] = not any(dominates(other, r) for other in results)
+    return results
 
 def main(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('-k', default=20, type=int)
     parser.add_argument('-m', default=5, type=int)
+    parser.add_argument('-p', '--probes', default=0, type=int,
+                        help='extra buckets to probe per query (multi-probe LSH)')
+    parser.add_argument('--fallback', action='store_true',
+                        help='answer queries without candidates by exact search')
+    parser.add_argument('--stats', default=None,
+                        help='json file for bucket-occupancy and query statistics')
+    parser.add_argument('--save', default=None, help='directory to store the built index in')
+    parser.add_argument('--load', default=None, help='directory of a stored index to use')
+    parser.add_argument('--tune', action='store_true',
+                        help='sweep a grid of (k, m) instead and report the Pareto-optimal ones')
+    parser.add_argument('--ks', nargs='+', default=[5, 10, 15, 20, 25, 30], type=int)
+    parser.add_argument('--ms', nargs='+', default=[1, 2, 5, 10, 20], type=int)
+    parser.add_argument('--tune-output', default=None, help='json file for all tuning results')
     args = parser.parse_args()
 
-    print("Running lsh.py with parameters k =", args.k, "and m =", args.m)
+    if args.tune:
+        results = tune(args.ks, args.ms, args.probes)
+        if args.tune_output:
+            with open(args.tune_output, 'w') as f:
+                json.dump(results, f, indent=2)
+        print("Pareto-optimal (k, m) with probes =", args.probes)
+        print("   k    m  recall@1   avg cand   p50 ms   p95 ms   p99 ms  build s   index B")
+        for r in sorted(results, key=lambda r: r['latency_p95_ms']):
+            if r['pareto']:
+                print("%4d %4d %9.3f %10.1f %8.3f %8.3f %8.3f %8.3f %9d" %
+                      (r['k'], r['m'], r['recall_at_1'], r['avg_candidates'],
+                       r['latency_p50_ms'], r['latency_p95_ms'],
+                       r['latency_p99_ms'], r['build_sec'], r['index_bytes']))
+        return
 
     # Now we calculate the nearest neighbor with brute force and with LSH.
-    me = lsh(args.k, args.m)
+    if args.load:
+        me = lsh.load(args.load)
+        print("Loaded lsh index with parameters k =", me.k, "and m =", me.m)
+    else:
+        print("Running lsh.py with parameters k =", args.k, "and m =", args.m)
+        me = lsh(args.k, args.m)
+    if args.save:
+        me.save(args.save)
 
     for r in range(1500, 1520): #1797
         im = me.data[r]
         (nn, distnn) = bf_search(im, me.data[:1500])
-        (ncand, distncand) = me.lsh_search(im) # ncad pot ser NULL! Compte!!
+        (ncand, distncand) = me.lsh_search(im, args.probes, args.fallback) # ncad pot ser NULL! Compte!!
         print(f"Image #{r}")
         print(f"The nearest neighbor with  bf_search is: {nn} with distance {distnn}")
         print(f"The nearest neighbor with lsh_search is: {ncand} with distance {distncand}")
 
+    # the same lookups, answered as one batch
+    ts = time.time()
+    nn, dist = me.lsh_search_many(me.data[1500:1520], probes=args.probes,
+                                  fallback=args.fallback)
+    te = time.time()
+    print('%r %2.4f sec for %d images' % ('lsh_search_many', te - ts, len(nn)))
+
+    if args.stats:
+        _, _, query_stats = me.lsh_search_many(me.data[1500:], probes=args.probes,
+                                               fallback=args.fallback, stats=True)
+        with open(args.stats, 'w') as f:
+            json.dump({'tables': me.table_stats(), 'queries': query_stats}, f, indent=2)
+        print("statistics written to", args.stats)
+
     return
 
 
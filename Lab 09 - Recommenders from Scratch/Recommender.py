@@ -8,11 +8,293 @@ __authors__ = David Berges Llado and Alex Carrillo Alza
 '''
 
 
+import os
 import csv
+import json
+import time
 import argparse
+import tempfile
 import numpy as np
+import scipy.sparse as sp
 
 from collections import OrderedDict
+from collections.abc import Mapping
+from multiprocessing import Pool
+from types import MappingProxyType
+
+
+class _RatingsView(Mapping):
+    ''' Read-only view of a compressed sparse matrix as the dict of dicts
+    {row id: {column id: rating}} of its non-empty rows. Rows are built on
+    access, and the last 'cache_size' ones are kept '''
+
+    def __init__(self, matrix, names, ids, col_names, cache_size = 1024):
+        # CSR (or CSC, viewed as the rows of its transpose)
+        self._m = matrix
+        self._names, self._ids = names, ids
+        self._col_names = col_names
+        self._cache = OrderedDict()
+        self._cache_size = cache_size
+
+    def __getitem__(self, key):
+        row = self._cache.get(key)
+        if row is not None:
+            self._cache.move_to_end(key)
+            return row
+        i = self._ids[key]
+        start, end = self._m.indptr[i], self._m.indptr[i + 1]
+        if start == end:
+            raise KeyError(key)
+        names = self._col_names
+        row = MappingProxyType(dict(zip([names[j] for j in self._m.indices[start:end].tolist()],
+                                        self._m.data[start:end].tolist())))
+        self._cache[key] = row
+        if len(self._cache) > self._cache_size:
+            self._cache.popitem(last = False)
+        return row
+
+    def __getstate__(self):
+        # the cached rows are mappingproxies, which cannot be pickled
+        state = self.__dict__.copy()
+        state['_cache'] = OrderedDict()
+        return state
+
+    def __contains__(self, key):
+        i = self._ids.get(key)
+        return i is not None and self._m.indptr[i] != self._m.indptr[i + 1]
+
+    def __iter__(self):
+        nonempty = np.flatnonzero(np.diff(self._m.indptr))
+        return (self._names[i] for i in nonempty.tolist())
+
+    def __len__(self):
+        return int(np.count_nonzero(np.diff(self._m.indptr)))
+
+
+class _LRUCache():
+    ''' Bounded cache that forgets its least recently used entries beyond 'size' ones,
+    and the entries stored more than 'ttl' seconds ago (if it is not None). Counts
+    the hits and misses of get '''
+
+    def __init__(self, size = 1024, ttl = None):
+        self._entries = OrderedDict()
+        self.size, self.ttl = size, ttl
+        self.hits, self.misses = 0, 0
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            stored, value = entry
+            if self.ttl is None or time.monotonic() - stored <= self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        self._entries[key] = (time.monotonic(), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last = False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def info(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries), 'size': self.size}
+
+
+class _SignatureIndex():
+    ''' Random-hyperplane signatures of the rows of a matrix, in 'tables' tables of
+    'bits' bits. A bit tells on which side of a random hyperplane a row lies, so rows
+    at a small angle tend to share codes. Every table keeps the rows sorted by code;
+    a query gets the rows of its bucket, plus 'probes' more buckets per table that
+    differ from it in one of its least certain bits '''
+
+    def __init__(self, X, bits = 8, tables = 8, probes = 0, seed = 0):
+        assert bits <= 64, 'codes are packed in 64 bit integers'
+        self.bits, self.tables, self.probes = bits, tables, probes
+        self._rng = np.random.default_rng(seed)
+        self._H = self._rng.standard_normal((X.shape[1], bits * tables))
+        self._codes = self._signatures(X @ self._H)
+        self._sort()
+
+    def _signatures(self, P):
+        ''' codes (rows x tables) of the projections P (rows x bits * tables) '''
+        P = np.asarray(P).reshape(len(P), self.tables, self.bits)
+        weights = np.left_shift(np.uint64(1), np.arange(self.bits, dtype = np.uint64))
+        return ((P > 0) * weights).sum(axis = 2, dtype = np.uint64)
+
+    def _sort(self):
+        self._order = np.argsort(self._codes, axis = 0, kind = 'stable')
+        self._sorted = np.take_along_axis(self._codes, self._order, axis = 0)
+
+    def update(self, rows, X, columns):
+        ''' new signatures of the 'rows' (X holds their rows, in that order), after the
+        matrix grew to 'columns' columns and to at least max(rows) + 1 rows '''
+        if columns > len(self._H):
+            # new columns get their coordinates in the same hyperplanes
+            extra = self._rng.standard_normal((columns - len(self._H), self._H.shape[1]))
+            self._H = np.vstack((self._H, extra))
+        grow = max(int(rows.max()) + 1 - len(self._codes), 0) if len(rows) else 0
+        self._codes = np.vstack((self._codes, np.zeros((grow, self.tables), dtype = np.uint64)))
+        self._codes[rows] = self._signatures(X @ self._H)
+        self._sort()
+
+    def candidates(self, cols, vals, probes = None):
+        ''' sorted rows that share a bucket with the vector with values 'vals' at the
+        columns 'cols' in some table (probing 'probes' more buckets, default self.probes) '''
+        probes = self.probes if probes is None else probes
+        P = (vals @ self._H[cols]).reshape(1, -1)
+        codes = self._signatures(P)[0]
+        P = P.reshape(self.tables, self.bits)
+        found = []
+        for t in range(self.tables):
+            keys = [codes[t]]
+            # the bits whose hyperplane is closest to the vector are the least certain
+            for b in np.argsort(np.abs(P[t]), kind = 'stable')[:probes].tolist():
+                keys.append(codes[t] ^ np.left_shift(np.uint64(1), np.uint64(b)))
+            keys = np.array(keys, dtype = np.uint64)
+            starts = np.searchsorted(self._sorted[:, t], keys, side = 'left')
+            ends = np.searchsorted(self._sorted[:, t], keys, side = 'right')
+            found.extend(self._order[start:end, t] for start, end in zip(starts.tolist(), ends.tolist()))
+        return np.unique(np.concatenate(found)) if found else np.zeros(0, dtype = np.int64)
+
+
+def _source_stamp(filenames):
+    ''' Size and modification time of every file, to tell when a cache is stale '''
+    stamp = {}
+    for name in filenames:
+        st = os.stat(name)
+        # the same file is the same source, however its path is spelled
+        stamp[os.path.abspath(name)] = [st.st_size, st.st_mtime_ns]
+    return stamp
+
+
+def _publish_cache(tmp, cache):
+    ''' Moves every file of the directory tmp into the directory cache and removes tmp.
+    The files are renamed over the old ones rather than rewritten, so processes that
+    memory-mapped the old ones keep reading them '''
+    for name in os.listdir(tmp):
+        os.replace(os.path.join(tmp, name), os.path.join(cache, name))
+    os.rmdir(tmp)
+
+
+def _parse_ratings(data, columns):
+    ''' Parses complete lines of a ratings file into (userids, movieids, ratings) arrays '''
+    lines = data.count(b'\n')
+    values = np.fromstring(data.replace(b'\r', b'').replace(b'\n', b','), sep = ',')
+    if values.size != lines * columns:
+        raise ValueError('ratings file is not made of numeric userId,movieId,rating,... lines')
+    values = values.reshape(lines, columns)
+    return values[:, 0].astype(np.int64), values[:, 1].astype(np.int64), values[:, 2].astype(np.float32)
+
+
+def read_ratings(filename, chunk_bytes = 1 << 26):
+    ''' Generator that parses a MovieLens ratings file (a userId,movieId,rating,... header
+    and numeric lines) about 'chunk_bytes' bytes at a time, so that the text of the whole
+    file is never in memory. Yields (userids, movieids, ratings) arrays for every chunk '''
+    with open(filename, 'rb') as f:
+        header = f.readline().strip().split(b',')
+        if header[:3] != [b'userId', b'movieId', b'rating']:
+            raise ValueError(f"{filename} is not a MovieLens ratings file")
+        rest = b''
+        while True:
+            data = f.read(chunk_bytes)
+            if not data:
+                break
+            data = rest + data
+            # parse up to the last complete line, the rest goes with the next chunk
+            end = data.rfind(b'\n') + 1
+            rest = data[end:]
+            if end:
+                yield _parse_ratings(data[:end], len(header))
+        if rest.strip():
+            yield _parse_ratings(rest + b'\n', len(header))
+
+
+def _dense_ids(values, names, ids):
+    ''' Maps numeric ids to dense integer ids, giving the next free one (in order of first
+    appearance) to the ids not in 'ids' yet, and appending their names to 'names' '''
+    uniq, first, inverse = np.unique(values, return_index = True, return_inverse = True)
+    for value in uniq[np.argsort(first, kind = 'stable')].tolist():
+        name = str(value)
+        if name not in ids:
+            ids[name] = len(names)
+            names.append(name)
+    lookup = np.array([ids[str(value)] for value in uniq.tolist()], dtype = np.int32)
+    return lookup[inverse]
+
+
+def _last_ratings(users, movies, ratings, nm):
+    ''' Keeps the last rating of every (user, movie) pair, and sorts them by user and movie '''
+    key = users.astype(np.int64) * nm + movies
+    _, last = np.unique(key[::-1], return_index = True)
+    last = len(key) - 1 - last
+    return users[last], movies[last], ratings[last]
+
+
+def _item_similarity_block(C, C2, P, cols):
+    ''' similarity_between_items between every movie and the movies 'cols', as a dense
+    (movies x len(cols)) array. C holds the ratings minus the mean of their movie, C2 its
+    squares and P the rating pattern, all as user x movie CSC matrices. The sums only run
+    over the users that rated both movies, so every term is a sparse co-rating product '''
+    num = (C.T @ C[:, cols]).toarray()
+    den_other = (C2.T @ P[:, cols]).toarray()
+    den_block = (P.T @ C2[:, cols]).toarray()
+    sim = np.zeros(num.shape)
+    ok = (den_other != 0) & (den_block != 0)
+    sim[ok] = num[ok] / np.sqrt(den_other[ok] * den_block[ok])
+    return sim
+
+
+def _top_neighbours(sim, top_n):
+    ''' For every column of 'sim', the rows of its 'top_n' highest similarities that
+    are at least .01, highest first and ties by lowest row, as (rows, similarities)
+    arrays of shape (columns x top_n), padded with -1 and 0 '''
+    sim = sim.T
+    if top_n < sim.shape[1]:
+        # everything above the top_n-th value, and the lowest rows among the ties with it
+        kth = -np.partition(-sim, top_n - 1, axis = 1)[:, top_n - 1:top_n]
+        above, tied = sim > kth, sim == kth
+        tied &= np.cumsum(tied, axis = 1) <= top_n - above.sum(axis = 1, keepdims = True)
+        part = np.nonzero(above | tied)[1].reshape(len(sim), top_n)
+    else:
+        part = np.broadcast_to(np.arange(sim.shape[1]), sim.shape)
+    vals = np.take_along_axis(sim, part, axis = 1)
+    order = np.lexsort((part, -vals), axis = 1)
+    rows = np.take_along_axis(part, order, axis = 1).astype(np.int32)
+    vals = np.take_along_axis(vals, order, axis = 1).astype(np.float32)
+    # predict_rating2 ignores the rest anyway
+    small = vals < .01
+    rows[small], vals[small] = -1, 0.
+    return rows, vals
+
+
+def _item_block(nm, max_bytes):
+    ''' Number of movies that can be compared with all the 'nm' movies at once in about
+    'max_bytes': _item_similarity_block and _top_neighbours hold a few dense (nm x block)
+    arrays at the same time, about 48 bytes per entry at their peak '''
+    return max(1, min(nm, max_bytes // (64 * max(nm, 1))))
+
+
+# matrices of the item index build, inherited by the pool workers
+_item_data = None
+
+def _item_index_init(data):
+    global _item_data
+    _item_data = data
+
+def _item_index_block(task):
+    start, end, top_n = task
+    C, C2, P = _item_data
+    sim = _item_similarity_block(C, C2, P, np.arange(start, end))
+    # a movie is not its own neighbour
+    sim[np.arange(start, end), np.arange(end - start)] = 0.
+    return _top_neighbours(sim, top_n)
+
 
 """implements a recommender system built from
    a movie list name
@@ -20,8 +302,45 @@ from collections import OrderedDict
 class Recommender():
 
     #"""initializes a recommender from a movie file and a ratings file"""
-    def __init__(self, movie_filename, rating_filename):
+    def __init__(self, movie_filename, rating_filename, cache = None,
+                 result_cache_size = 1024, result_cache_ttl = None):
+
+        # Neighbours (by rating profile and knn) and recommendations (by rating profile,
+        # method, knn and k) of recent requests, forgotten whenever the ratings change
+        self._neighbour_cache = _LRUCache(result_cache_size, result_cache_ttl)
+        self._result_cache = _LRUCache(result_cache_size, result_cache_ttl)
+
+        # With a cache directory, the parsed files are stored there and memory-mapped
+        # by later runs, until the size or mtime of one of them changes
+        fresh = False
+        if cache is not None:
+            stamp = _source_stamp([movie_filename, rating_filename])
+            try:
+                with open(os.path.join(cache, 'source.json'), 'r') as f:
+                    fresh = json.load(f) == stamp
+            except (OSError, ValueError):
+                pass
+
+        if fresh:
+            ratings, by_movie = self._read_cache(cache)
+        else:
+            ratings, by_movie = self._read_sources(movie_filename, rating_filename), None
+
+        self._build_matrices(*ratings, deduplicated = True, by_movie = by_movie)
+        if cache is not None and not fresh:
+            self._write_cache(cache, stamp, *ratings)
+
+
+    def _read_sources(self, movie_filename, rating_filename):
+        ''' Function that reads the movie file and the ratings file
+        ----------
+        Sets _movie_names, and the dense integer ids (in order of first appearance)
+        of users and movies.
+        ----------
+        RETURNS
+        - arrays with the user id, movie id and rating of every rating, as _last_ratings returns them
 
+        '''
         # read movie file and create dictionary _movie_names
         self._movie_names = {}
         with open(movie_filename, 'r', encoding = 'utf8') as csv_reader:
@@ -34,34 +353,204 @@ class Recommender():
                 # ignore line[2], genre
                 self._movie_names[movieid] = moviename
 
-        # read rating file and create _movie_ratings (ratings for a movie)
-        # and _user_ratings (ratings by a user) dicts
-        self._movie_ratings = {}
-        self._user_ratings = {}
-
-        with open(rating_filename, 'r', encoding = 'utf8') as csv_reader:
-            reader = csv.reader(csv_reader)
-            next(reader, None)
+        # read rating file a chunk at a time, ignoring the timestamps
+        self._users, self._user_ids = [], {}
+        self._movies, self._movie_ids = [], {}
+        users, movies, ratings = [], [], []
+        for userids, movieids, chunk in read_ratings(rating_filename):
+            users.append(_dense_ids(userids, self._users, self._user_ids))
+            movies.append(_dense_ids(movieids, self._movies, self._movie_ids))
+            ratings.append(chunk)
+
+        if not ratings:
+            users, movies, ratings = [np.zeros(0, np.int32)], [np.zeros(0, np.int32)], [np.zeros(0, np.float32)]
+        return _last_ratings(np.concatenate(users), np.concatenate(movies),
+                             np.concatenate(ratings), len(self._movies))
+
+
+    def _write_cache(self, cache, stamp, users, movies, ratings):
+        ''' Function that stores what _read_sources read in the directory 'cache', with
+        the arrays of _Rc so that _build_matrices does not have to sort them again '''
+        os.makedirs(cache, exist_ok = True)
+        stampfile = os.path.join(cache, 'source.json')
+        if os.path.exists(stampfile):
+            os.remove(stampfile)
+        tmp = tempfile.mkdtemp(dir = cache)
+        np.save(os.path.join(tmp, 'users.npy'), users)
+        np.save(os.path.join(tmp, 'movies.npy'), movies)
+        np.save(os.path.join(tmp, 'ratings.npy'), ratings)
+        np.save(os.path.join(tmp, 'movie_indptr.npy'), self._Rc.indptr)
+        np.save(os.path.join(tmp, 'movie_users.npy'), self._Rc.indices)
+        np.save(os.path.join(tmp, 'movie_ratings.npy'), self._Rc.data)
+        for name, ids in (('userids.txt', self._users), ('movieids.txt', self._movies)):
+            with open(os.path.join(tmp, name), 'w', encoding = 'utf8') as f:
+                f.write(''.join(i + '\n' for i in ids))
+        with open(os.path.join(tmp, 'titles.json'), 'w', encoding = 'utf8') as f:
+            json.dump(self._movie_names, f)
+        _publish_cache(tmp, cache)
+        # written last, so an interrupted write is never taken as fresh
+        with open(stampfile, 'w') as f:
+            json.dump(stamp, f)
+
+
+    def _read_cache(self, cache):
+        ''' Function that loads what _write_cache stored, memory-mapping the arrays
+        copy-on-write: pages are shared until add_ratings writes to them.
+        Returns the (users, movies, ratings) and the 'by_movie' arrays for _build_matrices '''
+        with open(os.path.join(cache, 'titles.json'), 'r', encoding = 'utf8') as f:
+            self._movie_names = json.load(f)
+        with open(os.path.join(cache, 'userids.txt'), 'r', encoding = 'utf8') as f:
+            self._users = f.read().split('\n')[:-1]
+        with open(os.path.join(cache, 'movieids.txt'), 'r', encoding = 'utf8') as f:
+            self._movies = f.read().split('\n')[:-1]
+        self._user_ids = {userid: i for i, userid in enumerate(self._users)}
+        self._movie_ids = {movieid: i for i, movieid in enumerate(self._movies)}
+        load = lambda name: np.load(os.path.join(cache, name + '.npy'), mmap_mode = 'c')
+        return ((load('users'), load('movies'), load('ratings')),
+                (load('movie_indptr'), load('movie_users'), load('movie_ratings')))
+
+
+    def _build_matrices(self, users, movies, ratings, deduplicated = False, by_movie = None):
+        ''' Function that builds the rating matrices from parallel arrays
+        ----------
+        PARAMETERS
+        - users, movies: integer ids of the user and the movie of every rating
+        - ratings: the ratings. If a user rated a movie more than once, the last one is kept
+        - deduplicated: True if the arrays already come from _last_ratings
+        - by_movie: the (indptr, indices, data) arrays of _Rc, if they are known
+        ----------
+        Sets _R (CSR, user x movie) and _Rc (the same matrix in CSC, so that its
+        columns are the ratings of a movie), the per-user and per-movie rating counts
+        and means, and the dict-like views _user_ratings and _movie_ratings over them.
 
-            for line in reader:
+        '''
+        nu, nm = len(self._users), len(self._movies)
+        if not deduplicated:
+            users, movies, ratings = _last_ratings(users, movies, ratings, nm)
+
+        # one rating per (user, movie), sorted: the CSR arrays are the ratings themselves
+        indptr = np.zeros(nu + 1, dtype = np.int32 if len(ratings) < 2**31 else np.int64)
+        np.cumsum(np.bincount(users, minlength = nu), out = indptr[1:])
+        # asarray keeps memory-mapped arrays mapped when their type is already the right one
+        self._R = sp.csr_matrix((np.asarray(ratings, dtype = np.float32), np.asarray(movies, dtype = np.int32),
+                                 indptr), shape = (nu, nm))
+        self._R.has_sorted_indices = True
+        if by_movie is None:
+            self._Rc = self._R.tocsc()
+            self._Rc.sort_indices()
+        else:
+            indptr, indices, data = by_movie
+            self._Rc = sp.csc_matrix((np.asarray(data), np.asarray(indices), np.asarray(indptr)), shape = (nu, nm))
+            self._Rc.has_sorted_indices = True
+
+        self._user_counts = np.diff(self._R.indptr)
+        self._movie_counts = np.diff(self._Rc.indptr)
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            self._user_means = np.asarray(self._R.sum(axis = 1, dtype = np.float64)).ravel() / self._user_counts
+            self._movie_means = np.asarray(self._Rc.sum(axis = 0, dtype = np.float64)).ravel() / self._movie_counts
+
+        # dict of dicts interface: _user_ratings[userid][movieid] and
+        # _movie_ratings[movieid][userid] give the rating
+        self._user_ratings = _RatingsView(self._R, self._users, self._user_ids, self._movies)
+        self._movie_ratings = _RatingsView(self._Rc, self._movies, self._movie_ids, self._users)
+
+        # built on demand by _item_matrices and build_item_index / load_item_index
+        self._item_data = None
+        self._item_index = None
+        # built by build_user_index
+        self._user_index = None
+
+
+    def add_ratings(self, batch):
+        ''' Function that adds new ratings to the recommender, or replaces existing ones
+        ----------
+        PARAMETERS
+        - batch: iterable of (userid, movieid, rating) tuples. Users and movies that the
+          recommender does not know are added. If a pair appears more than once, the last rating is kept
+        ----------
+        Updates the rating matrices, the counts and means of the users and movies that
+        got a rating and, if there is one, the item index (see _refresh_item_index).
+        Ratings of pairs already in the matrices are overwritten in place.
 
-                userid = line[0]
-                movieid = line[1]
-                rating = line[2]
-                # ignore line[3], timestamp
-                if userid in self._user_ratings:
-                    userrats = self._user_ratings[userid]
-                else:
-                    userrats = {}
-                userrats.update({movieid: float(rating)})
-                self._user_ratings[userid] = userrats
-
-                if movieid in self._movie_ratings:
-                    movierats = self._movie_ratings[movieid]
-                else:
-                    movierats = {}
-                movierats.update({userid: float(rating)})
-                self._movie_ratings[movieid] = movierats
+        '''
+        users, movies, ratings = [], [], []
+        for userid, movieid, rating in batch:
+            if userid not in self._user_ids:
+                self._user_ids[userid] = len(self._users)
+                self._users.append(userid)
+            if movieid not in self._movie_ids:
+                self._movie_ids[movieid] = len(self._movies)
+                self._movies.append(movieid)
+            users.append(self._user_ids[userid])
+            movies.append(self._movie_ids[movieid])
+            ratings.append(rating)
+        if not ratings:
+            return
+        nu, nm = len(self._users), len(self._movies)
+        users, movies, ratings = _last_ratings(np.array(users, dtype = np.int32), np.array(movies, dtype = np.int32),
+                                               np.array(ratings, dtype = np.float32), nm)
+
+        R, Rc = self._R, self._Rc
+        R.resize((nu, nm))
+        Rc.resize((nu, nm))
+        new = np.ones(len(ratings), dtype = bool)
+        for e, (u, m, rating) in enumerate(zip(users.tolist(), movies.tolist(), ratings.tolist())):
+            start, end = R.indptr[u], R.indptr[u + 1]
+            p = start + np.searchsorted(R.indices[start:end], m)
+            if p < end and R.indices[p] == m:
+                start, end = Rc.indptr[m], Rc.indptr[m + 1]
+                R.data[p] = Rc.data[start + np.searchsorted(Rc.indices[start:end], u)] = rating
+                new[e] = False
+        if new.any():
+            # new pairs are merged in, the matrices keep their sorted indices
+            B = sp.csr_matrix((ratings[new], (users[new], movies[new])), shape = (nu, nm), dtype = np.float32)
+            self._R, self._Rc = R + B, Rc + B.tocsc()
+            self._R.sort_indices()
+            self._Rc.sort_indices()
+
+        self._user_counts = np.diff(self._R.indptr)
+        self._movie_counts = np.diff(self._Rc.indptr)
+        changed_users, changed_movies = np.unique(users), np.unique(movies)
+        self._user_means = np.concatenate((self._user_means, np.full(nu - len(self._user_means), np.nan)))
+        self._movie_means = np.concatenate((self._movie_means, np.full(nm - len(self._movie_means), np.nan)))
+        self._user_means[changed_users] = (np.asarray(self._R[changed_users].sum(axis = 1, dtype = np.float64)).ravel()
+                                           / self._user_counts[changed_users])
+        self._movie_means[changed_movies] = (np.asarray(self._Rc[:, changed_movies].sum(axis = 0, dtype = np.float64)).ravel()
+                                             / self._movie_counts[changed_movies])
+
+        self._user_ratings = _RatingsView(self._R, self._users, self._user_ids, self._movies)
+        self._movie_ratings = _RatingsView(self._Rc, self._movies, self._movie_ids, self._users)
+        if self._item_data is not None:
+            if new.any():
+                # new pairs move the columns after them: _item_matrices lays them out again
+                # when they are needed (the item index is refreshed without them)
+                self._item_data = None
+            else:
+                # same pattern, only the columns of the changed movies are computed again
+                C, C2, _ = self._item_data
+                pos = np.concatenate([np.arange(Rc.indptr[m], Rc.indptr[m + 1]) for m in changed_movies.tolist()])
+                C.data[pos] = Rc.data[pos] - np.repeat(self._movie_means[changed_movies],
+                                                       self._movie_counts[changed_movies])
+                C2.data[pos] = C.data[pos] ** 2
+        if self._item_index is not None:
+            self._refresh_item_index(changed_movies)
+        if self._user_index is not None:
+            self._user_index.update(changed_users, self._centred_users(changed_users), nm)
+        self._neighbour_cache.clear()
+        self._result_cache.clear()
+
+
+    def cache_info(self):
+        ''' Function that returns the hits, misses, entries and size of the neighbour
+        cache and of the recommendation cache, as a dictionary of dictionaries '''
+        return {'neighbours': self._neighbour_cache.info(), 'results': self._result_cache.info()}
+
+
+    def _fingerprint(self, rating_list):
+        ''' Function that returns the same hashable key for equal rating lists, whatever
+        the order of their items and the type of their ratings. Movie ids are kept as
+        given: _query only knows them as strings, so 1 and '1' give different results '''
+        return frozenset((movie, float(rating)) for movie, rating in rating_list.items())
 
 
     ####
@@ -117,6 +606,71 @@ class Recommender():
         return num/den if (den != 0) else 0
 
 
+    def _query(self, rating_list):
+        ''' Function that maps a rating list to the movie ids of the recommender
+        ----------
+        PARAMETERS
+        - rating_list: dictionary representing a rating list for a new user
+        ----------
+        RETURNS
+        - array with the integer ids of the rated movies that the recommender knows
+        - array with their ratings
+        - float with the mean of the whole rating list
+
+        '''
+        avg = np.array(list(rating_list.values())).mean()
+        known = [(self._movie_ids[movie], rating) for movie, rating in rating_list.items()
+                 if movie in self._movie_ids]
+        cols = np.array([j for j, _ in known], dtype = np.int64)
+        vals = np.array([rating for _, rating in known], dtype = np.float64)
+        return cols, vals, avg
+
+
+    def user_similarities(self, rating_list, users = None):
+        ''' Function that computes similarity_between_users between a rating list and every user
+        ----------
+        PARAMETERS
+        - rating_list: dictionary representing a rating list for a new user
+        - users: array with the integer ids of the users to compare with (default: all of them)
+        ----------
+        RETURNS
+        - array with the similarity to every user (indexed by integer user id), or to 'users'
+
+        '''
+        cols, vals, avg = self._query(rating_list)
+        # Only the columns of the rated movies take part: one pass over their ratings
+        if users is None:
+            sub = self._Rc[:, cols].tocoo()
+            means = self._user_means
+            nu = len(self._users)
+        else:
+            sub = self._R[users][:, cols].tocoo()
+            means = self._user_means[users]
+            nu = len(users)
+        q = vals[sub.col] - avg
+        r = sub.data - means[sub.row]
+        num = np.bincount(sub.row, weights = q * r, minlength = nu)
+        den1 = np.bincount(sub.row, weights = q * q, minlength = nu)
+        den2 = np.bincount(sub.row, weights = r * r, minlength = nu)
+
+        sim = np.zeros(nu)
+        ok = (den1 != 0) & (den2 != 0)
+        sim[ok] = num[ok] / np.sqrt(den1[ok] * den2[ok])
+        return sim
+
+
+    def _top(self, scores, k):
+        ''' Function that returns the indices of the 'k' highest scores, highest first,
+        breaking ties by lowest index (partial selection, no full sort)
+        '''
+        if k < len(scores):
+            kth = np.partition(-scores, k - 1)[k - 1]
+            cand = np.flatnonzero(-scores <= kth)
+        else:
+            cand = np.arange(len(scores))
+        return cand[np.argsort(-scores[cand], kind = 'stable')][:k]
+
+
     def recommend_user_to_user(self, rating_list, knn = 50, k = 10):
         ''' Function that returns the 'k' most likely movies for a specific user to like
         ----------
@@ -129,31 +683,160 @@ class Recommender():
         - a dictionary with the 'k' highest recommended movies to watch for the user
 
         '''
-        neighbours = {}
-        for user, ratings in self._user_ratings.items():
-            neighbours[user] = self.similarity_between_users(rating_list, ratings)
-        # Sort the dictionary
-        neighbours = sorted(neighbours.items(), key = lambda x: -x[1])
-        # Stick with the closest 'knn' users
-        neighbours = OrderedDict(neighbours[:knn])
-
-        # Get the movies that have been reviewed by some of the knn neighbours and that
-        # the user has not reviewed.
-        movies_to_rate = set()
-        for user in neighbours.keys():
-            movies_to_rate = movies_to_rate.union(set(self._user_ratings[user].keys()))
-        movies_to_rate = [x for x in movies_to_rate if x not in rating_list.keys()]
-
-        # Predict the rating that our user would rate for each movie in 'movies_to_rate'
-        pred = {}
-        for movie in movies_to_rate:
-            pred[movie] = self.predict_rating(movie, neighbours)
-        # Sort the dictionary
-        pred = sorted(pred.items(), key = lambda x: -x[1])
-        # Stick with the first k movies
-        pred = OrderedDict(pred[:k])
+        profile = self._fingerprint(rating_list)
+        result = self._result_cache.get(('u2u', profile, knn, k))
+        if result is None:
+            # Stick with the closest 'knn' users
+            found = self._neighbour_cache.get((profile, knn))
+            if found is None:
+                found = self._user_neighbours(rating_list, knn)[:2]
+                self._neighbour_cache.put((profile, knn), found)
+            result = self._predict_from_neighbours(rating_list, *found, k)
+            self._result_cache.put(('u2u', profile, knn, k), result)
+        return OrderedDict(result)
+
+
+    def _user_neighbours(self, rating_list, knn, exact = False, probes = None):
+        ''' Function that finds the 'knn' users closest to a rating list
+        ----------
+        PARAMETERS
+        - rating_list: dictionary representing a rating list for a new user
+        - knn: integer representing the number of nearest neighbours to take into account
+        - exact: True to compare with every user even if there is a user index
+        - probes: integer overriding the probes of the user index
+        ----------
+        RETURNS
+        - arrays with the integer ids of the neighbours and their similarities, closest first
+        - integer with the number of users compared with
 
-        return pred
+        With a user index (build_user_index) only the users that share a bucket with the
+        rating list are compared, with the exact similarity. If there are none, all are.
+
+        '''
+        if self._user_index is not None and not exact:
+            cols, vals, avg = self._query(rating_list)
+            users = self._user_index.candidates(cols, vals - avg, probes)
+            if len(users):
+                sim = self.user_similarities(rating_list, users)
+                # users are sorted, so ties still go to the lowest user id
+                top = self._top(sim, knn)
+                return users[top], sim[top], len(users)
+        sim = self.user_similarities(rating_list)
+        neighbours = self._top(sim, knn)
+        return neighbours, sim[neighbours], len(sim)
+
+
+    def _centred_users(self, users = None):
+        ''' Function that returns the rows of 'users' (default: all) minus their mean '''
+        rows = self._R[users] if users is not None else self._R.copy()
+        means = self._user_means[users] if users is not None else self._user_means
+        rows = rows.astype(np.float64)
+        rows.data -= np.repeat(means, np.diff(rows.indptr))
+        return rows
+
+
+    def build_user_index(self, bits = None, tables = 8, probes = 1, seed = 0):
+        ''' Function that builds an approximate nearest-user index for recommend_user_to_user
+        ----------
+        PARAMETERS
+        - bits: integer representing the bits per signature (default: about 64 users per bucket)
+        - tables: integer representing the number of signature tables
+        - probes: integer representing the buckets probed per table besides the query's
+        - seed: integer seeding the random hyperplanes
+        ----------
+        The signatures are random-hyperplane ones of the mean-centred user rating vectors.
+        More tables and probes find more of the exact neighbours (recall) for more
+        users to compare with (latency); more bits do the opposite. See user_index_report.
+
+        '''
+        if bits is None:
+            bits = min(max(int(round(np.log2(len(self._users) / 64))), 1), 64)
+        self._user_index = _SignatureIndex(self._centred_users(), bits, tables, probes, seed)
+        self._neighbour_cache.clear()
+        self._result_cache.clear()
+
+
+    def user_index_report(self, profiles, knn = 50, k = 10, probes = (0, 1, 2, 4)):
+        ''' Function that compares the user index with the exact neighbour search
+        ----------
+        PARAMETERS
+        - profiles: list of rating lists to query with
+        - knn, k: as in recommend_user_to_user
+        - probes: the numbers of probes to try
+        ----------
+        RETURNS
+        - list with a dictionary per setting ('exact' first, then every number of probes)
+          with the mean fraction of users compared with, of exact neighbours found
+          (recall) and of exact top-k recommendations found, and the mean milliseconds
+          per recommendation
+
+        '''
+        settings = [('exact', True, None)] + [(p, False, p) for p in probes]
+        report = []
+        exact = []
+        for name, use_exact, p in settings:
+            compared, recall, overlap, seconds = [], [], [], 0.
+            for j, rating_list in enumerate(profiles):
+                time1 = time.perf_counter()
+                neighbours, sim, count = self._user_neighbours(rating_list, knn, use_exact, p)
+                pred = self._predict_from_neighbours(rating_list, neighbours, sim, k)
+                seconds += time.perf_counter() - time1
+                if use_exact:
+                    exact.append((set(neighbours.tolist()), set(pred)))
+                compared.append(count / len(self._users))
+                recall.append(len(exact[j][0] & set(neighbours.tolist())) / max(len(exact[j][0]), 1))
+                overlap.append(len(exact[j][1] & set(pred)) / max(len(exact[j][1]), 1))
+            report.append({'probes': name, 'compared': float(np.mean(compared)), 'recall': float(np.mean(recall)),
+                           'top_k': float(np.mean(overlap)), 'ms': 1000 * seconds / max(len(profiles), 1)})
+        return report
+
+
+    def _predict_from_neighbours(self, rating_list, neighbours, similarities, k):
+        ''' Function that does predict_rating for every movie rated by some neighbour
+        ----------
+        PARAMETERS
+        - rating_list: dictionary representing a rating list for a new user
+        - neighbours: array with the integer ids of the nearest users
+        - similarities: array with their similarities
+        - k: integer representing the number of recommendations to get
+        ----------
+        RETURNS
+        - a dictionary with the 'k' highest predicted movies the user has not rated
+
+        '''
+        pred, seen = self._user_predictions(neighbours, similarities)
+        # Movies reviewed by some of the neighbours that the user has not reviewed
+        cols, _, _ = self._query(rating_list)
+        seen[cols] = False
+        movies = np.flatnonzero(seen)
+        top = self._top(pred[movies], k)
+        return OrderedDict((self._movies[movies[j]], float(pred[movies[j]])) for j in top)
+
+
+    def _user_predictions(self, neighbours, similarities):
+        ''' Function that does predict_rating for every movie
+        ----------
+        RETURNS
+        - array with the predicted rating of every movie (0 if no neighbour can predict it)
+        - boolean array telling the movies reviewed by some of the neighbours
+
+        '''
+        rows = self._R[neighbours]
+        # We only want to consider significant positive similarities
+        w = np.where(similarities >= .01, similarities, 0.)
+        num = rows.T @ w
+        den = self._pattern(rows).T @ w
+        pred = np.zeros(len(self._movies))
+        ok = den != 0
+        pred[ok] = num[ok] / den[ok]
+        return pred, np.diff(rows.tocsc().indptr) > 0
+
+
+    def _pattern(self, matrix):
+        ''' Same sparse matrix with every stored rating replaced by 1 '''
+        pattern = matrix.copy()
+        pattern.data = np.ones_like(pattern.data)
+        return pattern
 
 
     ####
@@ -205,7 +888,140 @@ class Recommender():
         return num / den if (den != 0) else 0
 
 
-    def recommend_item_to_item(self, rating_list, knn, k):
+    def _item_matrices(self):
+        ''' Function that returns the matrices _item_similarity_block works on: the
+        ratings centred on the mean of their movie, their squares and the rating pattern
+        '''
+        if self._item_data is None:
+            self._item_data = self._centred_ratings(self._Rc)
+        return self._item_data
+
+
+    def _centred_ratings(self, X):
+        ''' Function that returns the matrices of _item_matrices for the user x movie CSC
+        matrix of ratings 'X'. The three of them share the pattern of X '''
+        data = X.data - np.repeat(self._movie_means, np.diff(X.indptr))
+        return tuple(sp.csc_matrix((values, X.indices, X.indptr), shape = X.shape)
+                     for values in (data, data * data, np.ones_like(data)))
+
+
+    def build_item_index(self, top_n = 100, block = None, workers = None, max_bytes = 1 << 28):
+        ''' Function that precomputes the 'top_n' most similar movies of every movie
+        ----------
+        PARAMETERS
+        - top_n: integer representing the number of neighbours kept per movie
+        - block: integer representing the number of movies compared with all the others at once
+          (default: as many as fit in 'max_bytes')
+        - workers: integer representing the number of processes (default: one per CPU)
+        - max_bytes: integer representing the memory each process may use for a block
+        ----------
+        Sets _item_index to a (neighbours, similarities) pair of (movies x top_n) arrays,
+        with the neighbours sorted by decreasing similarity_between_items. Only
+        similarities of at least .01 are kept, the rest of a row is padded with -1 and 0.
+
+        '''
+        nm = len(self._movies)
+        block = _item_block(nm, max_bytes) if block is None else max(1, min(block, nm))
+        tasks = [(start, min(start + block, nm), top_n) for start in range(0, nm, block)]
+        data = self._item_matrices()
+        if workers == 1:
+            _item_index_init(data)
+            blocks = [_item_index_block(task) for task in tasks]
+        else:
+            with Pool(workers, initializer = _item_index_init, initargs = (data,)) as pool:
+                blocks = pool.map(_item_index_block, tasks)
+        self._item_index = (np.concatenate([b[0] for b in blocks]),
+                            np.concatenate([b[1] for b in blocks]))
+        self._result_cache.clear()
+
+
+    def save_item_index(self, path):
+        ''' Function that writes the item index to the directory 'path', as
+        neighbours.npy (int32), similarities.npy (float32) and the movie ids of its rows
+        '''
+        os.makedirs(path, exist_ok = True)
+        neighbours, similarities = self._item_index
+        np.save(os.path.join(path, 'neighbours.npy'), neighbours)
+        np.save(os.path.join(path, 'similarities.npy'), similarities)
+        with open(os.path.join(path, 'movies.txt'), 'w', encoding = 'utf8') as f:
+            f.write('\n'.join(self._movies) + '\n')
+
+
+    def load_item_index(self, path):
+        ''' Function that memory-maps an item index written by save_item_index. It must
+        have been built from the same ratings file '''
+        with open(os.path.join(path, 'movies.txt'), 'r', encoding = 'utf8') as f:
+            movies = f.read().split()
+        if movies != self._movies:
+            raise ValueError(f"item index in {path} was built from other ratings")
+        self._item_index = (np.load(os.path.join(path, 'neighbours.npy'), mmap_mode = 'r'),
+                            np.load(os.path.join(path, 'similarities.npy'), mmap_mode = 'r'))
+        self._result_cache.clear()
+
+
+    def _refresh_item_index(self, movies, max_bytes = 1 << 28):
+        ''' Function that updates the item index after the ratings of 'movies' changed
+        ----------
+        PARAMETERS
+        - movies: array with the integer ids of the movies whose ratings changed
+        - max_bytes: integer representing the memory used for the movies compared at once
+        ----------
+        Only the similarities that involve one of 'movies' can change (their means and
+        co-raters are the only ones that moved), and they are only nonzero for movies
+        rated by some user along with them. So only the ratings of the users of 'movies'
+        are read: the lists of 'movies' are computed again from them, and their entries
+        in the lists of the co-rated movies are replaced. The movies that were just below
+        the top_n of a list are not known, so a list that loses one of them may miss them
+        until the next build_item_index.
+
+        '''
+        neighbours, similarities = self._item_index
+        nm, top_n = len(self._movies), neighbours.shape[1]
+        if len(neighbours) < nm or not neighbours.flags.writeable:
+            # rows for the new movies; a loaded index is read-only, so it is copied once
+            grow = nm - len(neighbours)
+            neighbours = np.concatenate((neighbours, np.full((grow, top_n), -1, dtype = np.int32)))
+            similarities = np.concatenate((similarities, np.zeros((grow, top_n), dtype = np.float32)))
+
+        # ratings are never taken away, so the movies that had one of 'movies' in their
+        # list are still co-rated with it: the lists of the other movies do not change
+        data = self._centred_ratings(self._R[np.unique(self._Rc[:, movies].indices)].tocsc())
+        rest = np.setdiff1d(np.flatnonzero(np.diff(data[2].indptr)), movies)
+
+        # drop the old similarities to the changed movies from the other lists; the
+        # lists of the changed movies are computed again from whole columns
+        changed = np.zeros(nm + 1, dtype = bool)
+        changed[movies] = True
+        ids, vals = neighbours[rest], similarities[rest]
+        # the -1 padding reads the False in the last position
+        stale = changed[ids]
+        ids[stale], vals[stale] = -1, 0.
+        # only the lists that lost an entry or get a new one have to be merged again
+        touched = stale.any(axis = 1)
+        block = _item_block(nm, max_bytes)
+        for start in range(0, len(movies), block):
+            cols = movies[start:start + block]
+            sim = _item_similarity_block(*data, cols)
+            # a movie is not its own neighbour
+            sim[cols, np.arange(len(cols))] = 0.
+            neighbours[cols], similarities[cols] = _top_neighbours(sim, top_n)
+            # merge the new similarities into the other lists, sorted as _top_neighbours does
+            touched |= (sim[rest] >= .01).any(axis = 1)
+            rows = np.flatnonzero(touched)
+            merged = np.hstack((ids[rows], np.broadcast_to(cols.astype(np.int32), (len(rows), len(cols)))))
+            values = np.hstack((vals[rows], sim[rest[rows]].astype(np.float32)))
+            order = np.lexsort((merged, -values), axis = 1)[:, :top_n]
+            merged = np.take_along_axis(merged, order, axis = 1)
+            values = np.take_along_axis(values, order, axis = 1)
+            small = values < .01
+            merged[small], values[small] = -1, 0.
+            ids[rows], vals[rows] = merged, values
+            touched[:] = False
+        neighbours[rest], similarities[rest] = ids, vals
+        self._item_index = (neighbours, similarities)
+
+
+    def recommend_item_to_item(self, rating_list, knn = 50, k = 10):
         ''' Function that returns the 'k' most likely movies for a specific user to like
         ----------
         PARAMETERS
@@ -216,34 +1032,163 @@ class Recommender():
         RETURNS
         - a dictionary with the 'k' highest recommended movies to watch for the user
 
+        With an item index (build_item_index / load_item_index) the neighbours of a movie
+        are the rated movies among its precomputed ones. Otherwise the similarities to the
+        rated movies are computed for this request.
+
         '''
-        # Get the movies that the user has not rated
-        movies_to_rate = [x for x in self._movie_ratings.keys() if x not in rating_list.keys()]
-
-        # Get the closest movies
-        neighbours = {}
-        for movie1 in movies_to_rate:
-            ratings = self._movie_ratings[movie1]
-            neighbours[movie1] = {}
-            for movie2 in rating_list.keys():
-                neighbours[movie1][movie2] = self.similarity_between_items(ratings, self._movie_ratings[movie2])
-
-        # Sort the dictionaries and select the first knn appearances
-        for movie in neighbours:
-            neighbours[movie] = sorted(neighbours[movie].items(), key = lambda x: -x[1])
-            neighbours[movie] = OrderedDict(neighbours[movie][:knn])
-        
-        # Predict the rating for every possible movie
-        pred = {}
-        for movie in neighbours:
-            pred[movie] = self.predict_rating2(rating_list, neighbours[movie])
-        # Sort the movies by rating and stick with the k first
-        pred = sorted(pred.items(), key = lambda x: -x[1])
-        pred = OrderedDict(pred[:k])
+        profile = self._fingerprint(rating_list)
+        result = self._result_cache.get(('i2i', profile, knn, k))
+        if result is not None:
+            return OrderedDict(result)
+
+        cols, vals, _ = self._query(rating_list)
+        pred = self._item_predictions(cols, vals, knn)
+        movies = np.setdiff1d(np.flatnonzero(self._movie_counts), cols)
+        top = self._top(pred[movies], k)
+        result = OrderedDict((self._movies[movies[j]], float(pred[movies[j]])) for j in top)
+        self._result_cache.put(('i2i', profile, knn, k), result)
+        return OrderedDict(result)
+
+
+    def _item_predictions(self, cols, vals, knn):
+        ''' Function that does predict_rating2 for every movie, given the integer ids
+        'cols' of the rated movies and their ratings 'vals' (see _query). Returns an array
+        with the predicted rating of every movie (0 if it has no positive neighbour) '''
+        nm = len(self._movies)
+        if self._item_index is not None:
+            neighbours, similarities = self._item_index
+            rating = np.full(nm + 1, np.nan)
+            rating[cols] = vals
+            # the -1 padding reads the NaN in the last position
+            rating = rating[neighbours]
+            rated = ~np.isnan(rating)
+            # the lists are sorted, so the closest 'knn' rated movies come first
+            rated &= np.cumsum(rated, axis = 1) <= knn
+            w = np.where(rated, similarities, 0.)
+            rating = np.where(rated, rating, 0.)
+        else:
+            sim = _item_similarity_block(*self._item_matrices(), cols)
+            # Sort the similarities and select the first knn appearances
+            order = np.argsort(-sim, axis = 1, kind = 'stable')[:, :knn]
+            sim = np.take_along_axis(sim, order, axis = 1)
+            # We only want to consider significant positive similarities
+            w = np.where(sim >= .01, sim, 0.)
+            rating = vals[order]
 
+        num, den = (w * rating).sum(axis = 1), w.sum(axis = 1)
+        pred = np.zeros(nm)
+        ok = den != 0
+        pred[ok] = num[ok] / den[ok]
         return pred
 
 
+    def predict_ratings(self, rating_list, movies, knn = 50, method = 'u2u'):
+        ''' Function that predicts the ratings of some movies for a specific user
+        ----------
+        PARAMETERS
+        - rating_list: dictionary representing a rating list for a new user
+        - movies: list of the movieIds to predict
+        - knn: integer representing the number of nearest neighbours to take into account
+        - method: 'u2u' (as recommend_user_to_user) or 'i2i' (as recommend_item_to_item)
+        ----------
+        RETURNS
+        - a dictionary with the predicted rating of every movie, 0 if it cannot be predicted
+
+        '''
+        if method == 'u2u':
+            pred, _ = self._user_predictions(*self._user_neighbours(rating_list, knn)[:2])
+        else:
+            cols, vals, _ = self._query(rating_list)
+            pred = self._item_predictions(cols, vals, knn)
+        return {movie: float(pred[self._movie_ids[movie]]) if movie in self._movie_ids else 0.
+                for movie in movies}
+
+def read_profiles(filename):
+    ''' Generator that reads a file of rating profiles, in the format of ratings.csv
+    (userId,movieId,rating,... with a header line). The lines of a profile must be
+    consecutive. Yields (userid, rating_list) for every profile '''
+    with open(filename, 'r', encoding = 'utf8') as csv_reader:
+        reader = csv.reader(csv_reader)
+        next(reader, None)
+
+        userid, rating_list = None, {}
+        for line in reader:
+            if line[0] != userid:
+                if rating_list:
+                    yield userid, rating_list
+                userid, rating_list = line[0], {}
+            rating_list[line[1]] = float(line[2])
+        if rating_list:
+            yield userid, rating_list
+
+
+# recommender of the batch workers: inherited through fork, or pickled once
+# per worker where processes are spawned
+_model = None
+
+def _serve_init(model):
+    global _model
+    _model = model
+
+def _serve_profile(task):
+    userid, rating_list, methods, knn, k = task
+    results = []
+    for method in methods:
+        recommend = _model.recommend_user_to_user if method == 'u2u' else _model.recommend_item_to_item
+        results.append((method, recommend(rating_list, knn, k)))
+    return userid, results
+
+
+def recommend_batch(recommender, profiles_filename, output_filename, methods = ('u2u', 'i2i'),
+                    knn = 50, k = 10, workers = None, chunksize = 8):
+    ''' Function that recommends movies to every profile of a file
+    ----------
+    PARAMETERS
+    - recommender: the Recommender, shared read-only by the worker processes
+    - profiles_filename: file of rating profiles (see read_profiles)
+    - output_filename: csv file with a userId,method,rank,movieId,rating line per recommendation
+    - methods: 'u2u' (recommend_user_to_user) and/or 'i2i' (recommend_item_to_item)
+    - knn, k: as in the recommend methods
+    - workers: integer representing the number of processes (default: one per CPU)
+    - chunksize: integer representing the number of profiles sent to a worker at once
+    ----------
+    RETURNS
+    - integer with the number of profiles, and float with the seconds it took
+
+    Profiles are read and results written as they come, in the order of the file.
+
+    '''
+    if 'i2i' in methods and recommender._item_index is None:
+        # built once here, so that the workers share it
+        recommender._item_matrices()
+    tasks = ((userid, rating_list, methods, knn, k) for userid, rating_list in read_profiles(profiles_filename))
+
+    time1 = time.time()
+    count = 0
+    with open(output_filename, 'w', encoding = 'utf8', newline = '') as f:
+        writer = csv.writer(f)
+        writer.writerow(['userId', 'method', 'rank', 'movieId', 'rating'])
+        if workers == 1:
+            _serve_init(recommender)
+            results = map(_serve_profile, tasks)
+            pool = None
+        else:
+            pool = Pool(workers, initializer = _serve_init, initargs = (recommender,))
+            results = pool.imap(_serve_profile, tasks, chunksize)
+        try:
+            for userid, recommended in results:
+                for method, pred in recommended:
+                    writer.writerows([userid, method, rank, movieid, rate]
+                                     for rank, (movieid, rate) in enumerate(pred.items(), 1))
+                count += 1
+        finally:
+            if pool is not None:
+                pool.terminate()
+    time2 = time.time()
+    return count, time2 - time1
+
+
 if __name__ == '__main__':
     # Parse the arguments
     parser = argparse.ArgumentParser()
@@ -253,45 +1198,94 @@ if __name__ == '__main__':
     parser.add_argument(
         '-k', default = 10, type = int, help = 'Number of objects shown to the user.'
     )
+    parser.add_argument(
+        '-cache', default = None, help = 'Directory of the binary cache of the CSV files (built if missing or stale).'
+    )
+    parser.add_argument(
+        '-item-index', default = None, help = 'Directory of the item-item similarity index (built if missing).'
+    )
+    parser.add_argument(
+        '-batch', default = None, help = 'File of rating profiles to recommend to, instead of asking for them.'
+    )
+    parser.add_argument(
+        '-output', default = 'recommendations.csv', help = 'Output file of -batch.'
+    )
+    parser.add_argument(
+        '-methods', default = 'u2u,i2i', help = 'Comma separated recommenders used by -batch (u2u, i2i).'
+    )
+    parser.add_argument(
+        '-workers', default = None, type = int, help = 'Number of processes for -batch and the item index.'
+    )
+    parser.add_argument(
+        '-user-index', action = 'store_true', help = 'Use an approximate nearest-user index for User-to-User.'
+    )
+    parser.add_argument(
+        '-probes', default = 1, type = int, help = 'Buckets probed per table by the user index (more: better recall, slower).'
+    )
+    parser.add_argument(
+        '-user-index-report', default = None, help = 'File of rating profiles to compare the user index with the exact search on.'
+    )
+    parser.add_argument(
+        '-top-n', default = 100, type = int, help = 'Neighbours per movie kept in the item index.'
+    )
     # Get the arguments
     args = parser.parse_args()
     knn = args.knn
     k = args.k
 
     # Create the class reading the files
-    r = Recommender("./ml-latest-small/movies.csv","./ml-latest-small/ratings.csv")
-
-    # Repeatedly, asks for a list of movies and ratings, and asks the Recommender to provide
-    # recommendations given this list and prints the titles of the recommended movies and their
-    # predicted rating:
-    while (input('New list of movie ratings? [y/n] : ') == 'y'):
-        print('\nEnd the list by typing 0 in the movieID\n')
-        rating_list = {}
-        movie = input('MovieID : ')
-        while (movie != '0'):
-            assert (float(movie) <= 193609) & (float(movie) >= 1), f"MovieID {movie} doesn't exist. Ensure it is in range(1,193609)"
-            # Input a rating and ensure it is valid
-            rating = float(input('Rating : '))
-            assert (rating <= 5.) & (rating >= .5), 'Rating range must be between 1 and 5'
-            # Append the rating to the rating list and ask for a new movieID
-            rating_list[movie] = rating
+    r = Recommender("./ml-latest-small/movies.csv","./ml-latest-small/ratings.csv", args.cache)
+    if args.item_index is not None:
+        if os.path.exists(args.item_index):
+            r.load_item_index(args.item_index)
+        else:
+            r.build_item_index(args.top_n, workers = args.workers)
+            r.save_item_index(args.item_index)
+
+    if args.user_index or args.user_index_report is not None:
+        r.build_user_index(probes = args.probes)
+
+    if args.user_index_report is not None:
+        profiles = [rating_list for _, rating_list in read_profiles(args.user_index_report)]
+        for row in r.user_index_report(profiles, knn, k):
+            print("probes {probes:>5}: {compared:6.1%} of users compared, recall {recall:6.1%}, "
+                  "top-k {top_k:6.1%}, {ms:8.3f} ms".format(**row))
+    elif args.batch is not None:
+        users, seconds = recommend_batch(r, args.batch, args.output, args.methods.split(','),
+                                         knn, k, args.workers)
+        print(f"{users} users in {seconds:.2f} s: {users / seconds:.1f} users/sec")
+    else:
+        # Repeatedly, asks for a list of movies and ratings, and asks the Recommender to provide
+        # recommendations given this list and prints the titles of the recommended movies and their
+        # predicted rating:
+        while (input('New list of movie ratings? [y/n] : ') == 'y'):
+            print('\nEnd the list by typing 0 in the movieID\n')
+            rating_list = {}
             movie = input('MovieID : ')
-        print()
-
-        # Predict the ratings using a User-to-User recommender
-        print('-' * 60)
-        print('Using User-to-User recommendation:')
-        recommended = r.recommend_user_to_user(rating_list, knn, k)
-        for movieid, rate in recommended.items():
-            print(f" - {r._movie_names[movieid]} : {rate}")
-        print()
-
-        print('-' * 60)
-        print('using Item-to-Item recommendation:')
-        recommended = r.recommend_item_to_item(rating_list, knn, k)
-        for movieid, rate in recommended.items():
-            print(f" - {r._movie_names[movieid]} : {rate}")
-        print()
+            while (movie != '0'):
+                assert (float(movie) <= 193609) & (float(movie) >= 1), f"MovieID {movie} doesn't exist. Ensure it is in range(1,193609)"
+                # Input a rating and ensure it is valid
+                rating = float(input('Rating : '))
+                assert (rating <= 5.) & (rating >= .5), 'Rating range must be between 1 and 5'
+                # Append the rating to the rating list and ask for a new movieID
+                rating_list[movie] = rating
+                movie = input('MovieID : ')
+            print()
+
+            # Predict the ratings using a User-to-User recommender
+            print('-' * 60)
+            print('Using User-to-User recommendation:')
+            recommended = r.recommend_user_to_user(rating_list, knn, k)
+            for movieid, rate in recommended.items():
+                print(f" - {r._movie_names[movieid]} : {rate}")
+            print()
+
+            print('-' * 60)
+            print('using Item-to-Item recommendation:')
+            recommended = r.recommend_item_to_item(rating_list, knn, k)
+            for movieid, rate in recommended.items():
+                print(f" - {r._movie_names[movieid]} : {rate}")
+            print()
         
 
 
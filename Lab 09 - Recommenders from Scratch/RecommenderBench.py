@@ -0,0 +1,212 @@
+#!/usr/bin/python
+
+'''
+
+Offline evaluation and latency benchmark for the recommenders in Recommender.py.
+
+Some users are taken out of ratings.csv and queried as new users: part of their
+ratings is the rating list, the rest is held out. For every method and knn, it
+reports the RMSE of the held-out ratings, precision@k of the recommendations
+(relevant: held-out ratings of at least --relevant) and p50/p95/p99 latency per
+recommendation, and writes them to a JSON report. With --scale, the other users
+are cloned (with jittered ratings) to show how every method degrades as the data
+grows.
+
+'''
+
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import numpy as np
+import scipy
+
+import Recommender as rec
+
+
+def read_table(filename):
+    ''' Function that reads a ratings file into (userids, movieids, ratings) arrays '''
+    parts = list(rec.read_ratings(filename))
+    return tuple(np.concatenate([part[j] for part in parts]) for j in range(3))
+
+
+def holdout(users, movies, ratings, test_users, fraction, min_ratings, seed):
+    ''' Function that splits the ratings for the evaluation
+    ----------
+    PARAMETERS
+    - users, movies, ratings: the arrays of read_table
+    - test_users: integer representing the number of users queried as new users
+    - fraction: float representing the fraction of their ratings held out
+    - min_ratings: integer representing the ratings a user needs to be a test user
+    - seed: integer seeding the choice of users and ratings
+    ----------
+    RETURNS
+    - boolean array telling the ratings of the training set (the other users)
+    - list with a (rating_list, held-out ratings) pair of dictionaries per test user
+
+    '''
+    rng = np.random.default_rng(seed)
+    ids, counts = np.unique(users, return_counts = True)
+    candidates = ids[counts >= min_ratings]
+    chosen = rng.choice(candidates, size = min(test_users, len(candidates)), replace = False)
+    train = ~np.isin(users, chosen)
+
+    tests = []
+    for user in np.sort(chosen).tolist():
+        rows = np.flatnonzero(users == user)
+        held = np.zeros(len(rows), dtype = bool)
+        held[rng.choice(len(rows), size = max(int(round(fraction * len(rows))), 1), replace = False)] = True
+        profile = {str(m): float(r) for m, r in zip(movies[rows[~held]].tolist(), ratings[rows[~held]].tolist())}
+        hidden = {str(m): float(r) for m, r in zip(movies[rows[held]].tolist(), ratings[rows[held]].tolist())}
+        tests.append((profile, hidden))
+    return train, tests
+
+
+def scale(users, movies, ratings, factor, seed, keep = .8):
+    '''
+    Synthetic data 'factor' times the size of the given ratings: every user is
+    cloned factor - 1 times with new ids. A clone rates a random 'keep' of the
+    movies of its user, each rating moved by -0.5, 0 or +0.5 within 0.5-5.
+    '''
+    if factor <= 1:
+        return users, movies, ratings
+    rng = np.random.default_rng(seed)
+    parts = [(users, movies, ratings)]
+    offset = int(users.max()) + 1
+    for clone in range(1, factor):
+        kept = rng.random(len(users)) < keep
+        jitter = rng.integers(-1, 2, size = int(kept.sum())) / 2
+        parts.append((users[kept] + clone * offset, movies[kept],
+                      np.clip(ratings[kept] + jitter, .5, 5.).astype(np.float32)))
+    return tuple(np.concatenate([part[j] for part in parts]) for j in range(3))
+
+
+def write_table(filename, users, movies, ratings):
+    with open(filename, 'w', encoding = 'utf8') as f:
+        f.write('userId,movieId,rating,timestamp\n')
+        for start in range(0, len(users), 1 << 20):
+            end = start + (1 << 20)
+            np.savetxt(f, np.column_stack((users[start:end], movies[start:end], ratings[start:end])),
+                       fmt = '%d,%d,%.1f,0')
+
+
+def evaluate(r, method, tests, knn, k, relevant):
+    '''
+    RMSE (over the held-out ratings that can be predicted), coverage (the
+    fraction that can), precision@k and latency percentiles of one method and
+    knn over the test users
+    '''
+    recommend = r.recommend_user_to_user if method.startswith('u2u') else r.recommend_item_to_item
+    errors, predicted, hits, latency = [], 0, [], []
+    for profile, hidden in tests:
+        time1 = time.perf_counter()
+        recommended = recommend(profile, knn, k)
+        latency.append(time.perf_counter() - time1)
+        good = {movie for movie, rating in hidden.items() if rating >= relevant}
+        hits.append(len(good & set(recommended)) / k)
+
+        pred = r.predict_ratings(profile, list(hidden), knn, method[:3])
+        for movie, rating in hidden.items():
+            if pred[movie] != 0:
+                errors.append(pred[movie] - rating)
+                predicted += 1
+    count = sum(len(hidden) for _, hidden in tests)
+    p50, p95, p99 = np.percentile(np.array(latency) * 1000, [50, 95, 99])
+    return {
+        "rmse": float(np.sqrt(np.mean(np.square(errors)))) if errors else None,
+        "coverage": predicted / count if count else None,
+        "precision_at_k": float(np.mean(hits)),
+        "p50_ms": p50,
+        "p95_ms": p95,
+        "p99_ms": p99,
+    }
+
+
+def build(movie_filename, table, methods, args):
+    '''
+    Yields (methods, recommender) for the recommenders the methods need: one
+    without indexes for 'u2u' and 'i2i', one with a user and an item index for
+    'u2u-index' and 'i2i-index'. The results cache is off, so that every
+    request is computed.
+    '''
+    with tempfile.TemporaryDirectory() as path:
+        filename = os.path.join(path, 'ratings.csv')
+        write_table(filename, *table)
+        plain = [m for m in methods if not m.endswith('-index')]
+        indexed = [m for m in methods if m.endswith('-index')]
+        if plain:
+            yield plain, rec.Recommender(movie_filename, filename, result_cache_size = 0)
+        if indexed:
+            r = rec.Recommender(movie_filename, filename, result_cache_size = 0)
+            if 'u2u-index' in indexed:
+                r.build_user_index(probes = args.probes)
+            if 'i2i-index' in indexed:
+                r.build_item_index(args.top_n, workers = args.workers)
+            yield indexed, r
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--movies', default = './ml-latest-small/movies.csv')
+    parser.add_argument('--ratings', default = './ml-latest-small/ratings.csv')
+    parser.add_argument('--methods', nargs = '*', default = ['u2u', 'i2i', 'u2u-index', 'i2i-index'])
+    parser.add_argument('--knn', nargs = '*', default = [10, 20, 50, 100], type = int)
+    parser.add_argument('-k', default = 10, type = int)
+    parser.add_argument('--scales', nargs = '*', default = [1], type = int,
+                        help = 'sizes of the training data, as multiples of ratings.csv (e.g. 1 10 100)')
+    parser.add_argument('--test-users', default = 50, type = int)
+    parser.add_argument('--holdout', default = .2, type = float, help = 'fraction of the ratings held out')
+    parser.add_argument('--min-ratings', default = 20, type = int)
+    parser.add_argument('--relevant', default = 4., type = float,
+                        help = 'lowest held-out rating that counts as a hit for precision@k')
+    parser.add_argument('--probes', default = 1, type = int, help = 'probes of the user index')
+    parser.add_argument('--top-n', default = 100, type = int, help = 'neighbours per movie in the item index')
+    parser.add_argument('--workers', default = None, type = int)
+    parser.add_argument('--seed', default = 0, type = int)
+    parser.add_argument('-o', '--output', default = 'recommender_bench.json')
+    args = parser.parse_args()
+
+    users, movies, ratings = read_table(args.ratings)
+    train, tests = holdout(users, movies, ratings, args.test_users, args.holdout, args.min_ratings, args.seed)
+
+    results = []
+    for factor in args.scales:
+        table = scale(users[train], movies[train], ratings[train], factor, args.seed)
+        for methods, r in build(args.movies, table, args.methods, args):
+            for method in methods:
+                for knn in args.knn:
+                    row = evaluate(r, method, tests, knn, args.k, args.relevant)
+                    row.update({
+                        "scale": factor,
+                        "users": len(r._users),
+                        "ratings": int(r._R.nnz),
+                        "method": method,
+                        "knn": knn,
+                        "k": args.k,
+                    })
+                    results.append(row)
+                    print("x%-4d %-10s knn %4d  rmse %6.4f  cover %5.1f%%  p@%d %5.3f  "
+                          "p50 %8.2f ms  p95 %8.2f ms  p99 %8.2f ms" %
+                          (factor, method, knn, row["rmse"] or float('nan'), 100 * (row["coverage"] or 0),
+                           args.k, row["precision_at_k"], row["p50_ms"], row["p95_ms"], row["p99_ms"]))
+
+    report = {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "scipy": scipy.__version__,
+        "cpus": os.cpu_count(),
+        "seed": args.seed,
+        "test_users": len(tests),
+        "holdout": args.holdout,
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent = 2)
+    print("report written to", args.output)
+
+if __name__ == "__main__":
+    sys.exit(main())